@@ -2,27 +2,31 @@ import pandas as pd
 import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
+from utils_preprocess import ngsim_table, join_weather
 
 us101_files = [
-    "us-101/trajectories-0750am-0805am_weather_5_features.csv",
-    "us-101/trajectories-0805am-0820am_weather_5_features.csv",
-    "us-101/trajectories-0820am-0835am_weather_5_features.csv",
+    "us-101/trajectories-0750am-0805am.txt",
+    "us-101/trajectories-0805am-0820am.txt",
+    "us-101/trajectories-0820am-0835am.txt",
 ]
 i80_files = [
-    "i-80/trajectories-0400-0415_weather_5_features.csv",
-    "i-80/trajectories-0500-0515_weather_5_features.csv",
-    "i-80/trajectories-0515-0530_weather_5_features.csv",
+    "i-80/trajectories-0400-0415.txt",
+    "i-80/trajectories-0500-0515.txt",
+    "i-80/trajectories-0515-0530.txt",
 ]
 files = us101_files + i80_files
 
+w_files = ["weather/Hollywood Freeway, 2005-06-15.csv"] * 3 + [
+    "weather/Bay area Emeryville Calif... 2005-04-13 to 2005-04-14.csv"
+] * 3
+weather_columns = ["temp", "humidity", "precip", "windspeed", "visibility"]
+
 print("Loading data...")
 data = pd.DataFrame()
 for i, file in enumerate(files):
-    traj = pd.read_csv(file)
-    traj = traj.drop("trajectory_time", axis=1)
-
-    # Fix the warning
-    # traj = pd.read_csv(file, sep='\s+', header=None, names=column_names)
+    # Trajectories from the binary column cache of the text file, weather joined by time
+    traj = pd.DataFrame(ngsim_table(file))
+    traj[weather_columns] = join_weather(traj["Global_Time"], w_files[i], weather_columns)
     traj.insert(0, "DatasetId", i + 1)
     traj["Vehicle_ID"] += i * 10000
     data = pd.concat([data, traj])
@@ -35,7 +35,7 @@ net.load_state_dict(torch.load('trained_models/no_weather_cslstm_m.tar'))
 if args['use_cuda']:
     net = net.cuda()
 
-tsSet = ngsimDataset('TestSet.npy')
+tsSet = ngsimDataset('TestSet')
 tsDataloader = DataLoader(tsSet,batch_size=128,shuffle=True,num_workers=8,collate_fn=tsSet.collate_fn)
 
 lossVals = torch.zeros(25).cuda()
@@ -1,19 +1,23 @@
 from __future__ import print_function
 import torch
 from model_weather import highwayNet
-from utils_weather import ngsimDataset,maskedNLL,maskedMSETest,maskedNLLTest
+from utils_weather import ngsimDataset,batchAssembler,sharedBatchLoader,maskedNLL,maskedMSETest,maskedNLLTest
 from torch.utils.data import DataLoader
 import time
 
 
 
+## Sample configuration (frames at 10 Hz): history length, future length and down sampling rate, picked when
+## the splits are opened (their valid samples are cached per configuration, see TrackStore.sample_index)
+t_h, t_f, d_s = 30, 50, 2
+
 ## Network Arguments
 args = {}
 args['use_cuda'] = True
 args['encoder_size'] = 64
 args['decoder_size'] = 128
-args['in_length'] = 16
-args['out_length'] = 25
+args['in_length'] = t_h//d_s + 1
+args['out_length'] = t_f//d_s
 args['grid_size'] = (13,3)
 args['soc_conv_depth'] = 64
 args['conv_3x1_depth'] = 16
@@ -37,11 +41,19 @@ net.load_state_dict(torch.load('trained_models/weather_cslstm_m.tar'))
 if args['use_cuda']:
     net = net.cuda()
 
-tsSet = ngsimDataset('TestSet_weather.npy')
-tsDataloader = DataLoader(tsSet,batch_size=128,shuffle=True,num_workers=8,collate_fn=tsSet.collate_fn)
+tsSet = ngsimDataset('TestSet', t_h=t_h, t_f=t_f, d_s=d_s, weather_features=args['weather_size'])
+# Batches built by: 'workers' (DataLoader workers), 'shared' (workers writing into shared memory batch slots,
+# see sharedBatchLoader) or 'assembler' (this process, on the device of the network, see batchAssembler)
+batch_loader = 'workers'
+if batch_loader == 'assembler':
+    tsDataloader = batchAssembler(tsSet,batch_size=128,shuffle=True,device='cuda' if args['use_cuda'] else 'cpu')
+elif batch_loader == 'shared':
+    tsDataloader = sharedBatchLoader(tsSet,batch_size=128,shuffle=True,num_workers=8)
+else:
+    tsDataloader = DataLoader(tsSet,batch_size=128,shuffle=True,num_workers=8,collate_fn=tsSet.collate_fn)
 
-lossVals = torch.zeros(25).cuda()
-counts = torch.zeros(25).cuda()
+lossVals = torch.zeros(args['out_length']).cuda()
+counts = torch.zeros(args['out_length']).cuda()
 
 
 for i, data in enumerate(tsDataloader):
@@ -37,7 +37,7 @@ net.load_state_dict(torch.load('trained_models/cslstm_m_weather_5.tar'))
 if args['use_cuda']:
     net = net.cuda()
 
-tsSet = ngsimDataset('TestSet_weather_5.npy')
+tsSet = ngsimDataset('TestSet', weather_features=args['weather_size'])
 tsDataloader = DataLoader(tsSet,batch_size=128,shuffle=True,num_workers=8,collate_fn=tsSet.collate_fn)
 
 lossVals = torch.zeros(25).cuda()
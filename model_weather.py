@@ -91,10 +91,13 @@ class highwayNet(nn.Module):
         _, (nbrs_enc,_) = self.enc_lstm(self.leaky_relu(self.ip_emb(nbrs)))
         nbrs_enc = nbrs_enc.view(nbrs_enc.shape[1], nbrs_enc.shape[2])
 
-        ## Masked scatter
-        soc_enc = torch.zeros_like(masks).float()
-        soc_enc = soc_enc.masked_scatter_(masks, nbrs_enc)
-        soc_enc = soc_enc.permute(0,3,2,1)
+        ## Scatter the neighbor encodings (in (sample, grid cell) order) into the occupied cells of the
+        ## (batch, 3, 13) masks; (batch, 3, 13, encoder_size) masks of older collate functions are accepted
+        if masks.dim() == 4:
+            masks = masks[..., 0]
+        cells = masks.reshape(-1).nonzero().squeeze(1)
+        soc_enc = nbrs_enc.new_zeros(masks.numel(), nbrs_enc.shape[1]).index_copy_(0, cells, nbrs_enc)
+        soc_enc = soc_enc.view(masks.shape[0], masks.shape[1], masks.shape[2], -1).permute(0,3,2,1)
 
         ## Apply convolutional social pooling:
         soc_enc = self.soc_maxpool(self.leaky_relu(self.conv_3x1(self.leaky_relu(self.soc_conv(soc_enc)))))
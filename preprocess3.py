@@ -1,6 +1,16 @@
 import numpy as np
-import pandas as pd
-from scipy.io import savemat
+from functools import partial
+from utils_preprocess import (
+    split_recording,
+    create_tracks,
+    cached_recording,
+    cached_weather,
+    ngsim_table,
+    ngsim_blocks,
+    load_shard,
+    process_recordings,
+)
+from track_store import save_store
 
 # Input files
 
@@ -21,183 +31,92 @@ i80_files = [
 ]
 files = us101_files + i80_files
 
-column_names = [
-    "Vehicle_ID",
-    "Frame_ID",
-    "Total_Frames",
-    "Global_Time",
-    "Local_X",
-    "Local_Y",
-    "Global_X",
-    "Global_Y",
-    "v_Length",
-    "v_Width",
-    "v_Class",
-    "v_Vel",
-    "v_Acc",
-    "Lane_ID",
-    "Preceding",
-    "Following",
-    "Space_Headway",
-    "Time_Headway",
-]
-
-# Load data and add dataset id
-print("Loading data...")
-data = []
-for i, file in enumerate(files):
-    traj = pd.read_csv(file, delim_whitespace=True, header=None, names=column_names)
-    # Fix the warning
-    # traj = pd.read_csv(file, sep='\s+', header=None, names=column_names)
-
-    traj.insert(0, "DatasetId", i + 1)
-    data.append(traj.to_numpy(dtype=np.float32))
-
-# Parse fields
-print("Parsing fields...")
-veh_trajs = [{} for _ in range(len(data))]  # Create an empty dictionary per dataset
-veh_times = [{} for _ in range(len(data))]
-
-# Select and process relevant columns
-traj = [
-    d[:, [0, 1, 2, 5, 6, 14]] for d in data
-]  # Take Dataset ID, Vehicle ID, Frame ID, Local X Y, Lane ID
-for i in range(len(traj)):
-    if i < 3:  # For datasets 0, 1, 2 (US-101 files), any Lane_ID >= 6 is set to 6
-        traj[i][traj[i][:, 5] >= 6, 5] = 6
-
-# Create empty columns for future (2 for behaviors, 13 * 3 for spatial grid)
-for i in range(len(traj)):
-    new_cols = np.full((traj[i].shape[0], 2 + 13 * 3), 0)
-    traj[i] = np.hstack((traj[i], new_cols))
-
-for i, t in enumerate(traj):
-    veh_ids = np.unique(t[:, 1])
-    for v_id in veh_ids:
-        veh_trajs[i][str(int(v_id))] = t[t[:, 1] == v_id]
-
-    time_frames = np.unique(t[:, 2])
-    for tf in time_frames:
-        veh_times[i][str(int(tf))] = t[t[:, 2] == tf]
-
-    for row in t:
-        time, ds_id, veh_id, lane = row[2], row[0], row[1], int(row[5])
-        veh_traj = veh_trajs[i][str(int(veh_id))]
-        ind = np.where(veh_traj[:, 2] == time)[0][0]
-
-        # Get lateral maneuver
-        ub = min(len(veh_traj) - 1, ind + 40)  # upper bound for time (4 seconds)
-        lb = max(0, ind - 40)  # lower bound for time (-4 seconds)
-
-        if veh_traj[ub, 5] > veh_traj[ind, 5] or veh_traj[ind, 5] > veh_traj[lb, 5]:
-            row[6] = 3  # turn right
-        elif veh_traj[ub, 5] < veh_traj[ind, 5] or veh_traj[ind, 5] < veh_traj[lb, 5]:
-            row[6] = 2  # turn left
-        else:
-            row[6] = 1  # no change direction
-
-        # Get longitudinal maneuver
-        ub = min(len(veh_traj) - 1, ind + 50)
-        lb = max(0, ind - 30)
-
-        # Keep speed
-        if ub == ind or lb == ind:
-            row[7] = 1
-        else:
-            v_hist = (veh_traj[ind, 4] - veh_traj[lb, 4] + 1e-6) / (ind - lb + 1e-6)
-            v_fut = (veh_traj[ub, 4] - veh_traj[ind, 4] + 1e-6) / (ub - ind + 1e-6)
-            row[7] = 2 if v_fut / v_hist < 0.8 else 1
-
-        # Populate grid locations
-        t_frame = veh_times[i][str(int(time))]
-        frame_ego = t_frame[t_frame[:, 5] == lane]
-        frame_l = t_frame[t_frame[:, 5] == lane - 1]
-        frame_r = t_frame[t_frame[:, 5] == lane + 1]
-
-        def update_grid(frames, start_idx):
-            for f in frames:
-                y = f[4] - row[4]
-                if abs(y) < 90:
-                    grid_ind = start_idx + int(round((y + 90) / 15))
-                    row[8 + grid_ind] = f[1]
-
-        update_grid(frame_l, 0)
-        update_grid(frame_ego, 13)
-        update_grid(frame_r, 26)
-
-# Split into train, validation, and test sets
-print("Splitting into train, validation, and test sets...")
-traj_all = np.vstack(traj)
-traj_tr, traj_val, traj_ts = [], [], []
-
-for i in range(6):
-    max_id = int(traj_all[traj_all[:, 0] == i + 1, 1].max())
-    ul1, ul2 = int(0.7 * max_id), int(0.8 * max_id)
-
-    traj_tr.append(traj_all[(traj_all[:, 0] == i + 1) & (traj_all[:, 1] <= ul1)])
-    traj_val.append(
-        traj_all[
-            (traj_all[:, 0] == i + 1) & (traj_all[:, 1] > ul1) & (traj_all[:, 1] <= ul2)
-        ]
-    )
-    traj_ts.append(traj_all[(traj_all[:, 0] == i + 1) & (traj_all[:, 1] > ul2)])
-
-# Organize tracks and save
-print("Saving mat files...")
-
-def create_tracks(traj_set):
-    max_veh_id = int(max([traj[:, 1].max() for traj in traj_set]))
-    max_ds_id = len(traj_set)
-    # tracks = np.full((max_ds_id, max_veh_id), None, dtype=object)
-    tracks = np.array([[None for x in range(31)] * max_veh_id for _ in range(max_ds_id)])
-
-    for ds_id, traj in enumerate(traj_set, start=1):
-        unique_ids = np.unique(traj[:, 1])
-        for veh_id in unique_ids:
-            track = traj[traj[:, 1] == veh_id][:, 2:5].T
-            tracks[ds_id - 1, int(veh_id) - 1] = track
-
-    return tracks
-
-# Train, Validation, Test tracks
-tracks_tr = create_tracks(traj_tr)
-tracks_val = create_tracks(traj_val)
-tracks_ts = create_tracks(traj_ts)
-
-# def filter_edge_cases(traj, tracks):
-#     """
-#     Filter edge cases from trajectory data based on the 3-second history condition.
-#     """
-#     inds = np.zeros(len(traj), dtype=bool)
-
-#     for k in range(len(traj)):
-#         dataset_id = k#traj[k, 0].astype(int)  # Dataset ID
-#         vehicle_id = traj[k,:,1].astype(int)  # Vehicle ID
-#         time_frame = traj[k,:,2]  # Current time frame
-#         veh_idx = vehicle_id - 1
-
-#         track = tracks[dataset_id][
-#             veh_idx
-#         ]  
-#         # Ensure track has at least 31 frames
-#         # if track is not None and len(track[0]) > 30:
-#             # Fetch track for dataset ID and vehicle ID; 30 frames = 3 seconds
-#         if track[0][30] <= time_frame and track[0][-1] > time_frame + 1:
-#             inds[k] = True
-
-#     return traj[inds]
-
-# traj_tr = np.array(traj_tr)
-# traj_val = np.array(traj_val)
-# traj_ts = np.array(traj_ts)
-# # Apply filtering
-# print("Filtering edge cases...")
-# filter_traj_tr = filter_edge_cases(traj_tr, tracks_tr)
-# filter_traj_val = filter_edge_cases(traj_val, tracks_val)
-# filter_traj_ts = filter_edge_cases(traj_ts, tracks_ts)
-
-# Save .mat files
-np.save("TrainSet.npy", {"traj": np.vstack(traj_tr), "tracks": tracks_tr})
-np.save("ValSet.npy", {"traj": np.vstack(traj_val), "tracks": tracks_val})
-np.save("TestSet.npy", {"traj": np.vstack(traj_ts), "tracks": tracks_ts})
-print("Done.")
+# Weather of each recording (hourly records), joined onto the tracks as a separate table
+w_files = ["weather/Hollywood Freeway, 2005-06-15.csv"] * 3 + [
+    "weather/Bay area Emeryville Calif... 2005-04-13 to 2005-04-14.csv"
+] * 3
+weather_columns = ["temp", "humidity", "precip", "windspeed", "visibility"]  # any subset is picked by ngsimDataset
+
+# Parallel preprocessing: worker processes, one recording each (0 = process recordings one after another)
+num_workers = 6
+
+# Cached preprocessing: the column selection is part of the cache key of the parsed recordings
+columns = ["DatasetId", "Vehicle_ID", "Frame_ID", "Local_X", "Local_Y", "Lane_ID"]
+cache_dir = "preprocess_cache"  # parsed and labeled recordings, keyed by file content and parameters
+split_ratios = (0.7, 0.8)  # train / validation / test boundaries, as fractions of the vehicles of a recording
+
+
+def load_recording(i, file):
+    # Load data (binary column cache of the text file) in blocks of bounded size and add dataset id
+    for t in ngsim_blocks(file, columns, i + 1):
+        if i < 3:  # For datasets 0, 1, 2 (US-101 files), any Lane_ID >= 6 is set to 6
+            t[t[:, 5] >= 6, 5] = 6
+
+        yield t
+
+
+def load_times(file):
+    return np.asarray(ngsim_table(file)["Global_Time"])
+
+
+def process_recording(i):
+    # Label maneuvers and populate grids, reusing the cached stages whose inputs did not change
+    shard = cached_recording(cache_dir, files[i], partial(load_recording, i), (i + 1, columns, i < 3), (6, 7, 8))
+    weather = cached_weather(cache_dir, files[i], load_times, w_files[i], weather_columns)
+    return shard, weather
+
+
+if __name__ == "__main__":
+    print("Loading data, labeling maneuvers, populating grids and joining weather...")
+    shards = process_recordings(process_recording, len(files), num_workers)
+
+    # Split into train, validation, and test sets
+    print("Splitting into train, validation, and test sets...")
+    traj, traj_tr, traj_val, traj_ts = [], [], [], []
+    index_tr, index_val, index_ts = [], [], []
+    # Weather records of all recordings (row 0: no record) and the record of every row of each recording
+    weather_table = [np.full((1, len(weather_columns)), np.nan, dtype=np.float32)]
+    weather_index = []
+    n_records = 1
+
+    for shard, weather_file in shards:
+        t, vehicles = load_shard(shard)
+        w = np.load(weather_file)
+        weather_table.append(w["values"])
+        weather_index.append(np.where(w["index"] >= 0, w["index"] + n_records, 0)[:, None])
+        n_records += len(w["values"])
+        # Rows of each set, gathered from the memory-mapped shard when the set is saved
+        (tr, ind_tr), (val, ind_val), (ts, ind_ts) = split_recording(t, vehicles, split_ratios)
+        traj.append(t)
+        traj_tr.append(tr)
+        traj_val.append(val)
+        traj_ts.append(ts)
+        index_tr.append(ind_tr)
+        index_val.append(ind_val)
+        index_ts.append(ind_ts)
+
+    # Organize tracks and save
+    print("Saving track stores...")
+
+    # Train, Validation, Test tracks
+    tracks_tr = create_tracks(traj, index_tr, [2, 3, 4])
+    tracks_val = create_tracks(traj, index_val, [2, 3, 4])
+    tracks_ts = create_tracks(traj, index_ts, [2, 3, 4])
+
+    # Weather record of every track row (same rows as the tracks)
+    weather_table = np.concatenate(weather_table)
+    weather_tr = create_tracks(weather_index, index_tr, [0], np.int16)
+    weather_val = create_tracks(weather_index, index_val, [0], np.int16)
+    weather_ts = create_tracks(weather_index, index_ts, [0], np.int16)
+
+    # Samples without a full history or a future are kept here and skipped by ngsimDataset (see valid_samples)
+
+    # Save track stores (memory-mapped by ngsimDataset, which picks the weather features)
+    # Samples are written one recording at a time
+    save_store("TrainSet", (t[rows] for t, rows in zip(traj, traj_tr)), tracks_tr,
+               weather_table, weather_tr.values[:, 0], weather_columns)
+    save_store("ValSet", (t[rows] for t, rows in zip(traj, traj_val)), tracks_val,
+               weather_table, weather_val.values[:, 0], weather_columns)
+    save_store("TestSet", (t[rows] for t, rows in zip(traj, traj_ts)), tracks_ts,
+               weather_table, weather_ts.values[:, 0], weather_columns)
+    print("Done.")
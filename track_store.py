@@ -0,0 +1,426 @@
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+#___________________________________________________________________________________________________________________________
+
+## Ragged table of tracks
+class TrackTable:
+    """
+    Tracks of all vehicles of a split, stored densely.
+
+    values holds the track rows (Frame ID, Local X, Local Y, ...) of all vehicles one after the
+    other; vehicle vehId of dataset dsId owns values[offsets[k]:offsets[k + 1]] with
+    k = slots[dsId - 1, vehId - 1] (-1 when the vehicle is not in the split). Only vehicles that
+    exist get a slot.
+
+    The frames of a track are increasing and mostly contiguous, so the row of a frame is found
+    from the first frame of the track (first_frames, read once when the table is built).
+    """
+
+    def __init__(self, values, offsets, slots):
+        self.values = values
+        self.offsets = offsets
+        self.slots = slots
+        starts = np.asarray(offsets[:-1])
+        nonempty = starts < np.asarray(offsets[1:])
+        self.first_frames = np.zeros(len(starts), dtype=np.float64)
+        if values.ndim == 2 and nonempty.any():
+            self.first_frames[nonempty] = values[starts[nonempty], 0]
+
+    ## Slot of a vehicle, -1 if the vehicle is not in the split
+    def slot(self, dsId, vehId):
+        if dsId < 1 or dsId > self.slots.shape[0] or vehId < 1 or vehId > self.slots.shape[1]:
+            return -1
+        return int(self.slots[dsId - 1, vehId - 1])
+
+    ## Track of a vehicle as (frames, columns) rows, or None if the vehicle is not in the split
+    def track(self, dsId, vehId):
+        k = self.slot(dsId, vehId)
+        if k < 0:
+            return None
+        return self.values[self.offsets[k] : self.offsets[k + 1]]
+
+    ## Row of values holding frame t of the track of slot k, -1 if the track has no such frame
+    def frame_row(self, k, t):
+        start, end = int(self.offsets[k]), int(self.offsets[k + 1])
+        row = start + int(t - self.first_frames[k])
+        if start <= row < end and self.values[row, 0] == t:
+            return row
+        # Frames missing in the track: search its (sorted) frames
+        row = start + int(np.searchsorted(self.values[start:end, 0], t))
+        if row < end and self.values[row, 0] == t:
+            return row
+        return -1
+
+    ## Vectorized slot: slots of arrays of dataset and vehicle IDs (-1 for vehicles not in the split)
+    def slots_of(self, dsIds, vehIds):
+        dsIds = np.asarray(dsIds, dtype=np.int64)
+        vehIds = np.asarray(vehIds, dtype=np.int64)
+        known = (dsIds >= 1) & (dsIds <= self.slots.shape[0]) & (vehIds >= 1) & (vehIds <= self.slots.shape[1])
+        k = np.full(dsIds.shape, -1, dtype=np.int64)
+        k[known] = self.slots[dsIds[known] - 1, vehIds[known] - 1]
+        return k
+
+    ## Vectorized frame_row: rows of frames t in the tracks of slots k (-1 if k < 0 or no such frame)
+    def frame_rows(self, k, t):
+        k = np.asarray(k, dtype=np.int64)
+        t = np.asarray(t, dtype=np.float64)
+        row = np.full(k.shape, -1, dtype=np.int64)
+        has = k >= 0
+        start, end = self.offsets[k[has]], self.offsets[k[has] + 1]
+        r = start + (t[has] - self.first_frames[k[has]]).astype(np.int64)
+        ok = (r >= start) & (r < end)
+        ok[ok] = self.values[r[ok], 0] == t[has][ok]
+        row[has] = np.where(ok, r, -1)
+        # Frames missing in the track: search them one by one
+        for i in np.flatnonzero(has)[~ok]:
+            row[i] = self.frame_row(k[i], t[i])
+        return row
+
+    ## Table from the former (dataset, vehicle) object array of (columns, frames) tracks
+    @classmethod
+    def from_objects(cls, tracks):
+        present = [(d, v) for d in range(tracks.shape[0]) for v in range(tracks.shape[1])
+                   if tracks[d, v] is not None and np.size(tracks[d, v]) > 0]
+        max_veh_id = max([v for _, v in present], default=-1) + 1
+        slots = np.full((tracks.shape[0], max_veh_id), -1, dtype=np.int32)
+        offsets = np.zeros(len(present) + 1, dtype=np.int64)
+        for k, (d, v) in enumerate(present):
+            slots[d, v] = k
+            offsets[k + 1] = offsets[k] + tracks[d, v].shape[1]
+        if present:
+            values = np.concatenate([tracks[d, v].T for d, v in present])
+        else:
+            values = np.zeros((0, 0), dtype=np.float32)
+        return cls(values, offsets, slots)
+
+
+## Rows of the history and future windows of a batch of track positions (see ngsimDataset.getHistory
+## and getFuture)
+def history_rows(tracks, k, row, t_h, d_s):
+    """
+    Rows of the t_h // d_s + 1 history positions (every d_s frames up to t_h frames back, oldest
+    first) of frames at track rows row, and whether the full history is there.
+
+    Args:
+    - tracks: TrackTable.
+    - k, row: Slots and rows of the frames (row -1: no frame, see TrackTable.frame_rows).
+    - t_h, d_s: History length and down sampling rate, in frames.
+    """
+    found = row >= 0
+    start = np.where(found, tracks.offsets[np.maximum(k, 0)], 0)
+    back = np.minimum(row - start, t_h)
+    n_hist = t_h // d_s + 1
+    rows = (row - back)[:, None] + d_s * np.arange(n_hist)
+    full = found & ((back + d_s) // d_s >= n_hist)
+    return np.where(full[:, None], rows, 0), full
+
+
+def future_rows(tracks, k, row, t_f, d_s):
+    """
+    Rows of the (up to t_f // d_s) future positions of frames at track rows row, and their number.
+
+    Args:
+    - tracks: TrackTable.
+    - k, row: Slots and rows of the frames, all found.
+    - t_f, d_s: Future length and down sampling rate, in frames.
+    """
+    end = np.minimum(tracks.offsets[k + 1], row + t_f + 1)
+    rows = row[:, None] + d_s * np.arange(1, t_f // d_s + 1)
+    length = np.maximum(end - row - 1, 0) // d_s
+    return np.where(rows < end[:, None], rows, 0), length
+
+
+## Samples with a full history and a future
+def valid_samples(traj, tracks, t_h, t_f, d_s):
+    """
+    Indices of the samples for which ngsimDataset returns a non-empty history and future: the
+    vehicle has t_h // d_s + 1 history positions (every d_s frames up to t_h frames back) and at
+    least one future position at the sample frame.
+
+    Args:
+    - traj: (samples, columns) samples (Dataset ID, Vehicle ID, Frame ID, ...).
+    - tracks: TrackTable of the split.
+    - t_h, t_f, d_s: History length, future length and down sampling rate, in frames.
+    """
+    n = len(traj)
+    ds = np.asarray(traj[:, 0]).astype(np.int64)
+    veh = np.asarray(traj[:, 1]).astype(np.int64)
+    t = np.asarray(traj[:, 2]).astype(np.int64)
+
+    # Track slot of every sample (-1 if the vehicle has no track)
+    slot = np.full(n, -1, dtype=np.int64)
+    known = (ds >= 1) & (ds <= tracks.slots.shape[0]) & (veh >= 1) & (veh <= tracks.slots.shape[1])
+    slot[known] = tracks.slots[ds[known] - 1, veh[known] - 1]
+    found = slot >= 0
+
+    # Position of the sample frame in its track, searched in the (slot, frame) order of all track rows
+    offsets = np.asarray(tracks.offsets)
+    frames = np.asarray(tracks.values[:, 0]).astype(np.int64)
+    row_slot = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    span = int(max(frames.max(initial=0), t.max(initial=0))) + 1
+    order = np.lexsort((frames, row_slot))
+    key = (row_slot * span + frames)[order]
+    target = slot * span + t
+    at = np.minimum(np.searchsorted(key, target), max(len(key) - 1, 0))
+    found &= len(key) > 0
+    found[found] = key[at[found]] == target[found]
+
+    pos = np.zeros(n, dtype=np.int64)
+    length = np.zeros(n, dtype=np.int64)
+    pos[found] = order[at[found]] - offsets[slot[found]]
+    length[found] = offsets[slot[found] + 1] - offsets[slot[found]]
+
+    # Same lengths as the history and future slices of ngsimDataset
+    n_hist = (np.minimum(pos, t_h) + d_s) // d_s
+    has_future = pos + d_s < np.minimum(length, pos + t_f + 1)
+    return np.flatnonzero(found & (n_hist >= t_h // d_s + 1) & has_future)
+
+
+## Memory-mappable track store, replacing the pickled {"traj": ..., "tracks": ...} .npy files
+#
+# A split is saved as a directory holding flat binary arrays and a small JSON header:
+#   header.json  - shapes and version of the arrays below
+#   traj.bin     - float32 (samples, columns), one row per sample (Dataset ID, Vehicle ID, Frame ID, ...)
+#   tracks.bin   - float32 (rows, columns), TrackTable values: the track rows (Frame ID, Local X,
+#                  Local Y, ...) of all vehicles, one vehicle after the other
+#   offsets.bin  - int64 (vehicles + 1), TrackTable offsets of every vehicle slot
+#   slots.bin    - int32 (datasets, max_veh_id), TrackTable slot of every vehicle ID (-1 if absent)
+#   weather_table.bin - optional float32 (records, weather columns), the hourly weather records of
+#                  all recordings, named by "weather_columns" in the header; row 0 is NaN (no record)
+#   weather_index.bin - optional int16 (rows,), weather_table row of every track row (same offsets
+#                  and slots as tracks.bin)
+#   samples_h<t_h>_f<t_f>_s<d_s>.bin - int64 (samples,), derived: valid_samples of a (t_h, t_f, d_s)
+#                  configuration, written the first time a dataset opens the store with it (see
+#                  TrackStore.sample_index) and removed with the other arrays when the store is saved again
+# Every array is opened with np.memmap, so opening a split reads only the header and processes
+# (e.g. DataLoader workers) share the pages of the same files. Version 2 stores kept the weather
+# of every track row in weather.bin, float32 (rows, weather columns). The tracks hold every frame of
+# every vehicle, whatever history and future lengths the samples are later built with.
+
+store_version = 3
+
+
+def _open_array(path, dtype, shape):
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    # Copy-on-write: pages stay shared, and views handed to torch.from_numpy are writable. Plain
+    # ndarray view of the map: slicing a np.memmap costs several times more per sample.
+    return np.memmap(path, dtype=dtype, mode="c", shape=tuple(shape)).view(np.ndarray)
+
+
+def _write_array(path, array, dtype):
+    # Write an array, or the (rows, columns) blocks of an iterable one after another
+    blocks = [array] if isinstance(array, np.ndarray) else array
+    shape = None
+    with open(path, "wb") as f:
+        for block in blocks:
+            block = np.ascontiguousarray(block, dtype=dtype)
+            shape = list(block.shape) if shape is None else [shape[0] + len(block)] + shape[1:]
+            f.write(block.data)
+    return {"shape": shape or [0, 0], "dtype": np.dtype(dtype).name}
+
+
+## Write a split to the track store
+def save_store(path, traj, tracks, weather_table=None, weather_index=None, weather_columns=(), source=None):
+    """
+    Save the samples and tracks of a split as a track store directory.
+
+    Args:
+    - path: Directory of the store (created if needed).
+    - traj: (samples, columns) array of samples, or an iterable of row blocks of it (written one
+      block at a time, e.g. one per recording).
+    - tracks: TrackTable of the split, as built by create_tracks.
+    - weather_table: Optional (records, weather columns) weather records, row 0 being NaN.
+    - weather_index: weather_table row of every row of tracks.values (stored as int16).
+    - weather_columns: Names of the weather columns.
+    - source: Optional size and modification time of the split the store was converted from.
+    """
+    if weather_table is not None and len(weather_table) > np.iinfo(np.int16).max + 1:
+        raise ValueError("%s: %d weather records do not fit an int16 index" % (path, len(weather_table)))
+    os.makedirs(path, exist_ok=True)
+    arrays = {
+        "traj": (traj, np.float32),
+        "tracks": (tracks.values, np.float32),
+        "offsets": (tracks.offsets, np.int64),
+        "slots": (tracks.slots, np.int32),
+    }
+    if weather_table is not None:
+        arrays["weather_table"] = (weather_table, np.float32)
+        arrays["weather_index"] = (weather_index, np.int16)
+    header = {"version": store_version, "weather_columns": list(weather_columns)}
+    if source is not None:
+        header["source"] = source
+    for name, (array, dtype) in arrays.items():
+        header[name] = _write_array(os.path.join(path, name + ".bin"), array, dtype)
+    with open(os.path.join(path, "header.json"), "w") as f:
+        json.dump(header, f, indent=2)
+    # Arrays of a store saved before in the same directory (e.g. weather.bin of version 2)
+    for name in os.listdir(path):
+        if name.endswith(".bin") and name[:-4] not in arrays:
+            os.remove(os.path.join(path, name))
+
+
+## Memory-mapped view of a track store
+class TrackStore:
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "header.json")) as f:
+            self.header = json.load(f)
+        version = self.header["version"]
+        if version not in (1, 2, store_version):
+            raise ValueError("%s: unsupported track store version %s" % (path, version))
+
+        self.traj = self._open("traj")
+        offsets = self._open("offsets")
+        if version == 1:
+            # Version 1 kept one (possibly empty) slot per (dataset, vehicle ID)
+            n_ds, max_veh_id = self.header["n_datasets"], self.header["max_veh_id"]
+            slots = np.arange(n_ds * max_veh_id, dtype=np.int32)
+            slots[offsets[1:] == offsets[:-1]] = -1
+            slots = slots.reshape(n_ds, max_veh_id)
+        else:
+            slots = self._open("slots")
+        self.tracks = TrackTable(self._open("tracks"), offsets, slots)
+        # Weather of the track rows: records and the record of every row (version 3), or per-row
+        # weather (version 2, weather_index is None)
+        self.weather_table = self.weather_index = None
+        if "weather_table" in self.header:
+            self.weather_table = np.array(self._open("weather_table"))
+            self.weather_index = self._open("weather_index")
+        elif "weather" in self.header:
+            self.weather_table = self._open("weather")
+        self.weather_columns = self.header.get("weather_columns", [])
+
+    def _open(self, name):
+        spec = self.header[name]
+        return _open_array(os.path.join(self.path, name + ".bin"), spec["dtype"], spec["shape"])
+
+    ## valid_samples of a configuration, cached in the store directory
+    def sample_index(self, t_h, t_f, d_s):
+        path = os.path.join(self.path, "samples_h%d_f%d_s%d.bin" % (t_h, t_f, d_s))
+        if os.path.exists(path):
+            return _open_array(path, np.int64, [os.path.getsize(path) // 8])
+        index = valid_samples(self.traj, self.tracks, t_h, t_f, d_s)
+        # Written under a temporary name first (processes opening the store at the same time); a
+        # read-only store derives the index again every time
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            _write_array(tmp, index, np.int64)
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return index
+
+
+## Split of any format as a track store
+#
+# Pickled .npy and .mat splits hold their tracks as a (dataset, vehicle) object array, which every
+# DataLoader worker would otherwise get a private copy of (pickled to spawned workers, or copied on
+# write by reference counting in forked ones). They are converted on first use to a track store
+# next to the file, <file>.store/, rebuilt when the file changes size or modification time.
+def open_split(path):
+    """
+    Open a split as a memory-mapped TrackStore.
+
+    Args:
+    - path: Track store directory, or pickled .npy / .mat split.
+    """
+    if os.path.isdir(path):
+        return TrackStore(path)
+    store = path + ".store"
+    stat = os.stat(path)
+    source = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if os.path.exists(os.path.join(store, "header.json")):
+        with open(os.path.join(store, "header.json")) as f:
+            if json.load(f).get("source") == source:
+                return TrackStore(store)
+
+    traj, tracks = _load_objects(path)
+    tmp = "%s.%d.tmp" % (store, os.getpid())
+    save_store(tmp, traj, TrackTable.from_objects(tracks), source=source)
+    del traj, tracks
+    if os.path.exists(store):
+        shutil.rmtree(store)
+    os.replace(tmp, store)
+    return TrackStore(store)
+
+
+## Version of a track store and size and modification time of its samples and tracks, recorded by the
+## arrays derived from it (e.g. a materialized split) to tell whether they are still current
+def store_stamp(path):
+    with open(os.path.join(path, "header.json")) as f:
+        stamp = {"path": os.path.abspath(path), "version": json.load(f)["version"]}
+    for name in ("traj", "tracks"):
+        stat = os.stat(os.path.join(path, name + ".bin"))
+        stamp[name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    return stamp
+
+
+def _load_objects(path):
+    if path[-3:] == "mat":
+        import scipy.io as scp
+
+        data = scp.loadmat(path)
+    else:
+        data = np.load(path, allow_pickle=True).item()
+    return data["traj"], data["tracks"]
+
+
+## Directories of flat binary arrays with a header.json, like the track store (e.g. the materialized
+## samples of utils_weather.materialize)
+def save_arrays(path, blocks, dtypes, **header):
+    """
+    Write arrays given as row blocks to a directory of .bin files and a header.json.
+
+    Args:
+    - path: Directory (created if needed).
+    - blocks: Iterable of {name: block} dicts; the blocks of each array are written one after another.
+    - dtypes: {name: dtype} of the arrays.
+    - header: Other entries of the header (JSON serializable).
+    """
+    os.makedirs(path, exist_ok=True)
+    shapes = {name: None for name in dtypes}
+    files = {name: open(os.path.join(path, name + ".bin"), "wb") for name in dtypes}
+    try:
+        for block_set in blocks:
+            for name, block in block_set.items():
+                block = np.ascontiguousarray(block, dtype=dtypes[name])
+                shape = shapes[name]
+                shapes[name] = list(block.shape) if shape is None else [shape[0] + len(block)] + shape[1:]
+                files[name].write(block.data)
+    finally:
+        for f in files.values():
+            f.close()
+    for name, dtype in dtypes.items():
+        header[name] = {"shape": shapes[name] or [0], "dtype": np.dtype(dtype).name}
+    with open(os.path.join(path, "header.json"), "w") as f:
+        json.dump(header, f, indent=2)
+
+
+def open_arrays(path):
+    """
+    Header and memory-mapped arrays of a directory written by save_arrays.
+
+    Args:
+    - path: Directory.
+    """
+    with open(os.path.join(path, "header.json")) as f:
+        header = json.load(f)
+    arrays = {name: _open_array(os.path.join(path, name + ".bin"), spec["dtype"], spec["shape"])
+              for name, spec in header.items() if isinstance(spec, dict) and "shape" in spec}
+    return header, arrays
+
+
+## Convert pickled .npy splits: python track_store.py TrainSet_weather.npy ValSet_weather.npy ...
+if __name__ == "__main__":
+    for npy_file in sys.argv[1:]:
+        traj, tracks = _load_objects(npy_file)
+        save_store(os.path.splitext(npy_file)[0], traj, TrackTable.from_objects(tracks))
+        print("Saved", os.path.splitext(npy_file)[0])
@@ -1,19 +1,23 @@
 from __future__ import print_function
 import torch
 from model_weather import highwayNet
-from utils_weather import ngsimDataset,maskedNLL,maskedMSE,maskedNLLTest
+from utils_weather import ngsimDataset,batchAssembler,sharedBatchLoader,blockShuffleSampler,strideSampler,maskedNLL,maskedMSE,maskedNLLTest
 from torch.utils.data import DataLoader
 import time
 import math
 
 
+## Sample configuration (frames at 10 Hz): history length, future length and down sampling rate, picked when
+## the splits are opened (their valid samples are cached per configuration, see TrackStore.sample_index)
+t_h, t_f, d_s = 30, 50, 2
+
 ## Network Arguments
 args = {}
 args['use_cuda'] = True
 args['encoder_size'] = 64
 args['decoder_size'] = 128
-args['in_length'] = 16
-args['out_length'] = 25
+args['in_length'] = t_h//d_s + 1
+args['out_length'] = t_f//d_s
 args['grid_size'] = (13,3)
 args['soc_conv_depth'] = 64
 args['conv_3x1_depth'] = 16
@@ -42,16 +46,40 @@ crossEnt = torch.nn.BCELoss()
 
 
 ## Initialize data loaders
-trSet = ngsimDataset('TrainSet_weather.npy')
-valSet = ngsimDataset('ValSet_weather.npy')
-trDataloader = DataLoader(trSet,batch_size=batch_size,shuffle=True,num_workers=8,collate_fn=trSet.collate_fn)
-valDataloader = DataLoader(valSet,batch_size=batch_size,shuffle=True,num_workers=8,collate_fn=valSet.collate_fn)
+trSet = ngsimDataset('TrainSet', t_h=t_h, t_f=t_f, d_s=d_s, weather_features=args['weather_size'])
+valSet = ngsimDataset('ValSet', t_h=t_h, t_f=t_f, d_s=d_s, weather_features=args['weather_size'])
+# Training samples visited in shuffled blocks of block_size samples of the same recording and range of vehicles
+# (nearby track reads, see blockShuffleSampler); 0: uniform shuffle
+block_size = 0
+# Training samples of every frame_stride-th frame of each vehicle per epoch, at an offset rotating every epoch
+# (see strideSampler; takes precedence over block_size); 1: all the samples every epoch
+frame_stride = 1
+if frame_stride > 1:
+    trSampler = strideSampler(trSet, frame_stride)
+elif block_size:
+    trSampler = blockShuffleSampler(trSet, block_size)
+else:
+    trSampler = None
+# Batches built by: 'workers' (DataLoader workers), 'shared' (workers writing into shared memory batch slots,
+# see sharedBatchLoader) or 'assembler' (this process, on the device of the network, see batchAssembler)
+batch_loader = 'workers'
+if batch_loader == 'assembler':
+    device = 'cuda' if args['use_cuda'] else 'cpu'
+    trDataloader = batchAssembler(trSet,batch_size=batch_size,shuffle=True,device=device,sampler=trSampler)
+    valDataloader = batchAssembler(valSet,batch_size=batch_size,shuffle=True,device=device)
+elif batch_loader == 'shared':
+    trDataloader = sharedBatchLoader(trSet,batch_size=batch_size,shuffle=True,num_workers=8,sampler=trSampler)
+    valDataloader = sharedBatchLoader(valSet,batch_size=batch_size,shuffle=True,num_workers=8)
+else:
+    trDataloader = DataLoader(trSet,batch_size=batch_size,shuffle=trSampler is None,sampler=trSampler,num_workers=8,collate_fn=trSet.collate_fn)
+    valDataloader = DataLoader(valSet,batch_size=batch_size,shuffle=True,num_workers=8,collate_fn=valSet.collate_fn)
 
 
 ## Variables holding train and validation loss values:
 train_loss = []
 val_loss = []
 prev_val_loss = math.inf
+train_start = time.time()  # validation loss is also reported against wall-clock training time
 
 for epoch_num in range(pretrainEpochs+trainEpochs):
     if epoch_num == 0:
@@ -119,8 +147,8 @@ for epoch_num in range(pretrainEpochs+trainEpochs):
         avg_tr_time += batch_time
 
         if i%100 == 99:
-            eta = avg_tr_time/100*(len(trSet)/batch_size-i)
-            print("Epoch no:",epoch_num+1,"| Epoch progress(%):",format(i/(len(trSet)/batch_size)*100,'0.2f'), "| Avg train loss:",format(avg_tr_loss/100,'0.4f'),"| Acc:",format(avg_lat_acc,'0.4f'),format(avg_lon_acc,'0.4f'), "| Validation loss prev epoch",format(prev_val_loss,'0.4f'), "| ETA(s):",int(eta))
+            eta = avg_tr_time/100*(len(trDataloader)-i)
+            print("Epoch no:",epoch_num+1,"| Epoch progress(%):",format(i/len(trDataloader)*100,'0.2f'), "| Avg train loss:",format(avg_tr_loss/100,'0.4f'),"| Acc:",format(avg_lat_acc,'0.4f'),format(avg_lon_acc,'0.4f'), "| Validation loss prev epoch",format(prev_val_loss,'0.4f'), "| ETA(s):",int(eta))
             train_loss.append(avg_tr_loss/100)
             avg_tr_loss = 0
             avg_lat_acc = 0
@@ -182,7 +210,7 @@ for epoch_num in range(pretrainEpochs+trainEpochs):
     print(avg_val_loss/val_batch_count)
 
     # Print validation loss and update display variables
-    print('Validation loss :',format(avg_val_loss/val_batch_count,'0.4f'),"| Val Acc:",format(avg_val_lat_acc/val_batch_count*100,'0.4f'),format(avg_val_lon_acc/val_batch_count*100,'0.4f'))
+    print('Validation loss :',format(avg_val_loss/val_batch_count,'0.4f'),"| Val Acc:",format(avg_val_lat_acc/val_batch_count*100,'0.4f'),format(avg_val_lon_acc/val_batch_count*100,'0.4f'),"| Wall-clock(h):",format((time.time()-train_start)/3600,'0.3f'))
     val_loss.append(avg_val_loss/val_batch_count)
     prev_val_loss = avg_val_loss/val_batch_count
 
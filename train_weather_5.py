@@ -42,8 +42,8 @@ crossEnt = torch.nn.BCELoss()
 
 
 ## Initialize data loaders
-trSet = ngsimDataset("TrainSet_weather_5.npy")
-valSet = ngsimDataset("ValSet_weather_5.npy")
+trSet = ngsimDataset("TrainSet", weather_features=args["weather_size"])
+valSet = ngsimDataset("ValSet", weather_features=args["weather_size"])
 trDataloader = DataLoader(
     trSet,
     batch_size=batch_size,
@@ -1,8 +1,8 @@
 from __future__ import print_function, division
 from torch.utils.data import Dataset, DataLoader
-import scipy.io as scp
 import numpy as np
 import torch
+from track_store import TrackStore, open_split, history_rows, future_rows
 
 #___________________________________________________________________________________________________________________________
 
@@ -14,14 +14,12 @@ class ngsimDataset(Dataset):
         # self.D = scp.loadmat(mat_file)['traj']
         # self.T = scp.loadmat(mat_file)['tracks']
 
-        if mat_file[-3:] == "mat":
-            self.D = scp.loadmat(mat_file)["traj"]
-            self.T = scp.loadmat(mat_file)["tracks"]
-        else:
-            self.D = np.load(mat_file, allow_pickle=True)
-            self.T = np.load(mat_file, allow_pickle=True)
-            self.D = self.D.item()["traj"]
-            self.T = self.T.item()["tracks"]
+        # Track store (pickled .npy / .mat splits are converted to one on first use): memory-mapped, so
+        # DataLoader workers share its pages instead of holding a copy of the split each
+        self.mat_file = mat_file
+        self.store = open_split(mat_file)
+        self.D = self.store.traj
+        self.T = self.store.tracks
 
         self.t_h = t_h  # length of track history
         self.t_f = t_f  # length of predicted trajectory
@@ -29,14 +27,19 @@ class ngsimDataset(Dataset):
         self.enc_size = enc_size # size of encoder LSTM
         self.grid_size = grid_size # size of social context grid
 
+        # Samples with a full history and a future for this (t_h, t_f, d_s); the others would only be padded
+        # with zeros. Derived from the tracks (which hold every frame) and cached in the store per configuration
+        self.index = self.store.sample_index(t_h, t_f, d_s)
+
 
 
     def __len__(self):
-        return len(self.D)
+        return len(self.index)
 
 
 
     def __getitem__(self, idx):
+        idx = self.index[idx]
 
         dsId = self.D[idx, 0].astype(int)
         vehId = self.D[idx, 1].astype(int)
@@ -61,105 +64,171 @@ class ngsimDataset(Dataset):
         return hist,fut,neighbors,lat_enc,lon_enc
 
 
+    ## Batched fetch, called by DataLoader with the indices of a batch instead of __getitem__
+    def __getitems__(self, indices):
+        """
+        Samples of a batch as arrays, gathered from the tracks with one fancy index per window
+        (same values as __getitem__); collate_fn turns them into the batch tensors.
+
+        Returns a dict of:
+        - hist: (samples, t_h // d_s + 1, ...) histories.
+        - fut, fut_len: (samples, t_f // d_s, 2) futures (zero padded) and their lengths.
+        - nbrs: (neighbors, t_h // d_s + 1, 2) neighbor histories, in (sample, grid cell) order.
+        - nbr_sample, nbr_cell: Sample and grid cell of every neighbor.
+        - lat_enc, lon_enc: (samples, 3) and (samples, 2) one-hot maneuvers.
+        """
+        samples = self.D[self.index[np.asarray(indices, dtype=np.int64)]]
+        dsIds = samples[:, 0].astype(np.int64)
+        t = samples[:, 2]
+        grid = samples[:, 8:].astype(np.int64)
+
+        # Ego history and future, relative to the ego position at frame t
+        k = self.T.slots_of(dsIds, samples[:, 1])
+        row = self.T.frame_rows(k, t)
+        refPos = self.T.values[row, 1:3]
+        rows, full = history_rows(self.T, k, row, self.t_h, self.d_s)
+        hist = np.where(full[:, None, None], self.T.values[rows, 1:3] - refPos[:, None], 0)
+        rows, fut_len = future_rows(self.T, k, row, self.t_f, self.d_s)
+        fut = self.T.values[rows, 1:3] - refPos[:, None]
+        fut[np.arange(fut.shape[1]) >= fut_len[:, None]] = 0
+
+        # Neighbor histories with a full history, in (sample, grid cell) order
+        nbr_k = self.T.slots_of(np.repeat(dsIds, grid.shape[1]), grid.ravel())
+        nbr_row = self.T.frame_rows(nbr_k, np.repeat(t, grid.shape[1]))
+        rows, full = history_rows(self.T, nbr_k, nbr_row, self.t_h, self.d_s)
+        nbr_sample, nbr_cell = np.divmod(np.flatnonzero(full), grid.shape[1])
+        nbrs = self.T.values[rows[full], 1:3] - refPos[nbr_sample, None]
+
+        # Maneuvers (one-hot)
+        lat_enc = np.eye(3)[samples[:, 6].astype(np.int64) - 1]
+        lon_enc = np.eye(2)[samples[:, 7].astype(np.int64) - 1]
+
+        return {"hist": hist, "fut": fut, "fut_len": fut_len, "nbrs": nbrs,
+                "nbr_sample": nbr_sample, "nbr_cell": nbr_cell, "lat_enc": lat_enc, "lon_enc": lon_enc}
+
+
+
+    ## Helper function to get the track of a vehicle as rows (Frame ID, Local X, Local Y), None if absent
+    def getTrack(self, vehId, dsId):
+        return self.T.track(dsId, vehId)
+
+
+
+    ## Reopen the memory maps instead of pickling the arrays (DataLoader workers started with spawn)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["store"], state["D"], state["T"] = self.store.path, None, None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.store = TrackStore(self.store)
+        self.D = self.store.traj
+        self.T = self.store.tracks
+
+
 
     ## Helper function to get track history
     def getHistory(self,vehId,t,refVehId,dsId):
         if vehId == 0:
             return np.empty([0,2])
-        else:
-            if self.T.shape[1]<=vehId-1:
-                return np.empty([0,2])
-            # refTrack = self.T[dsId-1][refVehId-1].transpose()
-            # vehTrack = self.T[dsId-1][vehId-1].transpose()
-            ## Updated ##
-            refTrack = self.T[dsId - 1][refVehId - 1]
-            vehTrack = self.T[dsId - 1][vehId - 1]
-
-            if refTrack is None or vehTrack is None:
-                return np.empty([0, 2])
-
-            refTrack = refTrack.transpose()
-            vehTrack = vehTrack.transpose()
-            ##
-            refPos = refTrack[np.where(refTrack[:,0]==t)][0,1:3]
-
-            if vehTrack.size==0 or np.argwhere(vehTrack[:, 0] == t).size==0:
-                 return np.empty([0,2])
-            else:
-                stpt = np.maximum(0, np.argwhere(vehTrack[:, 0] == t).item() - self.t_h)
-                enpt = np.argwhere(vehTrack[:, 0] == t).item() + 1
-                hist = vehTrack[stpt:enpt:self.d_s,1:3]-refPos
-                # hist_w = vehTrack[stpt:enpt:self.d_s,-3:]-refPos
-            if len(hist) < self.t_h//self.d_s + 1:
-                return np.empty([0,2])
-            return hist
+        # Track slots and rows of frame t (constant time, see TrackTable.frame_row)
+        refSlot = self.T.slot(dsId, refVehId)
+        vehSlot = self.T.slot(dsId, vehId)
+        if refSlot < 0 or vehSlot < 0:
+            return np.empty([0,2])
+        refRow = self.T.frame_row(refSlot, t)
+        vehRow = self.T.frame_row(vehSlot, t)
+        if refRow < 0 or vehRow < 0:
+            return np.empty([0,2])
+
+        refPos = self.T.values[refRow, 1:3]
+        stpt = max(int(self.T.offsets[vehSlot]), vehRow - self.t_h)
+        enpt = vehRow + 1
+        hist = self.T.values[stpt:enpt:self.d_s, 1:3] - refPos
+        if len(hist) < self.t_h//self.d_s + 1:
+            return np.empty([0,2])
+        return hist
 
 
 
     ## Helper function to get track future
     def getFuture(self, vehId, t,dsId):
-        vehTrack = self.T[dsId-1][vehId-1].transpose()
-        refPos = vehTrack[np.where(vehTrack[:, 0] == t)][0, 1:3]
-        stpt = np.argwhere(vehTrack[:, 0] == t).item() + self.d_s
-        enpt = np.minimum(len(vehTrack), np.argwhere(vehTrack[:, 0] == t).item() + self.t_f + 1)
-        fut = vehTrack[stpt:enpt:self.d_s,1:3]-refPos
+        vehSlot = self.T.slot(dsId, vehId)
+        vehRow = self.T.frame_row(vehSlot, t)
+        refPos = self.T.values[vehRow, 1:3]
+        stpt = vehRow + self.d_s
+        enpt = min(int(self.T.offsets[vehSlot + 1]), vehRow + self.t_f + 1)
+        fut = self.T.values[stpt:enpt:self.d_s, 1:3] - refPos
         return fut
 
 
 
     ## Collate function for dataloader
     def collate_fn(self, samples):
+        if isinstance(samples, dict):
+            return self.collate_batch(samples)
 
-        # Initialize neighbors and neighbors length batches:
-        nbr_batch_size = 0
-        for _,_,nbrs,_,_ in samples:
-            nbr_batch_size += sum([len(nbrs[i])!=0 for i in range(len(nbrs))])
+        # Pack the samples of __getitem__ into the arrays of __getitems__
         maxlen = self.t_h//self.d_s + 1
-        nbrs_batch = torch.zeros(maxlen,nbr_batch_size,2)
-
-
-        # Initialize social mask batch:
-        pos = [0, 0]
-        mask_batch = torch.zeros(len(samples), self.grid_size[1],self.grid_size[0],self.enc_size)
-        mask_batch = mask_batch.byte()
+        hist, fut, nbrs, lat_enc, lon_enc = zip(*samples)
+        fut, fut_len = pack_sequences(fut, self.t_f//self.d_s, 2)
+
+        # Neighbors with a history, in (sample, grid cell) order
+        n_cells = self.grid_size[0] * self.grid_size[1]
+        nbrs = [nbr for sample_nbrs in nbrs for nbr in sample_nbrs]
+        occupied = np.flatnonzero(np.fromiter(map(len, nbrs), dtype=np.int64, count=len(nbrs)))
+        nbr_sample, nbr_cell = np.divmod(occupied, n_cells)
+
+        batch = {
+            "hist": pack_sequences(hist, maxlen, 2)[0],
+            "fut": fut,
+            "fut_len": fut_len,
+            "nbrs": pack_sequences([nbrs[i] for i in occupied], maxlen, 2)[0],
+            "nbr_sample": nbr_sample,
+            "nbr_cell": nbr_cell,
+            "lat_enc": np.array(lat_enc, dtype=np.float32).reshape(-1, 3),
+            "lon_enc": np.array(lon_enc, dtype=np.float32).reshape(-1, 2),
+        }
+        return self.collate_batch(batch)
+
+
+
+    ## Batch tensors (same as collate_fn) from the arrays of __getitems__
+    def collate_batch(self, batch):
+        n_fut = self.t_f//self.d_s
+        hist_batch = torch.from_numpy(np.ascontiguousarray(batch["hist"].transpose(1, 0, 2), dtype=np.float32))
+        nbrs_batch = torch.from_numpy(np.ascontiguousarray(batch["nbrs"].transpose(1, 0, 2), dtype=np.float32))
+        fut_batch = torch.from_numpy(np.ascontiguousarray(batch["fut"].transpose(1, 0, 2), dtype=np.float32))
+        op_mask = np.arange(n_fut)[:, None] < batch["fut_len"][None, :]
+        op_mask_batch = torch.from_numpy(np.repeat(op_mask[:, :, None], 2, axis=2).astype(np.float32))
+        lat_enc_batch = torch.from_numpy(batch["lat_enc"].astype(np.float32))
+        lon_enc_batch = torch.from_numpy(batch["lon_enc"].astype(np.float32))
+
+        # Social mask: occupancy of the grid cell (id % 13, id // 13) of every neighbor (the model scatters the
+        # neighbor encodings into the occupied cells)
+        mask_batch = torch.zeros(len(batch["hist"]), self.grid_size[1], self.grid_size[0], dtype=torch.bool)
+        cell = torch.from_numpy(batch["nbr_cell"])
+        mask_batch[torch.from_numpy(batch["nbr_sample"]), cell // self.grid_size[0], cell % self.grid_size[0]] = True
 
+        return hist_batch, nbrs_batch, mask_batch, lat_enc_batch, lon_enc_batch, fut_batch, op_mask_batch
 
-        # Initialize history, history lengths, future, output mask, lateral maneuver and longitudinal maneuver batches:
-        hist_batch = torch.zeros(maxlen,len(samples),2)
-        fut_batch = torch.zeros(self.t_f//self.d_s,len(samples),2)
-        op_mask_batch = torch.zeros(self.t_f//self.d_s,len(samples),2)
-        lat_enc_batch = torch.zeros(len(samples),3)
-        lon_enc_batch = torch.zeros(len(samples), 2)
+#________________________________________________________________________________________________________________________________________
 
 
-        count = 0
-        for sampleId,(hist, fut, nbrs, lat_enc, lon_enc) in enumerate(samples):
-
-            # Set up history, future, lateral maneuver and longitudinal maneuver batches:
-            hist_batch[0:len(hist),sampleId,0] = torch.from_numpy(hist[:, 0])
-            hist_batch[0:len(hist), sampleId, 1] = torch.from_numpy(hist[:, 1])
-            fut_batch[0:len(fut), sampleId, 0] = torch.from_numpy(fut[:, 0])
-            fut_batch[0:len(fut), sampleId, 1] = torch.from_numpy(fut[:, 1])
-            op_mask_batch[0:len(fut),sampleId,:] = 1
-            lat_enc_batch[sampleId,:] = torch.from_numpy(lat_enc)
-            lon_enc_batch[sampleId, :] = torch.from_numpy(lon_enc)
-
-            # Set up neighbor, neighbor sequence length, and mask batches:
-            for id,nbr in enumerate(nbrs):
-                if len(nbr)!=0:
-                    # print(nbr)
-                    nbrs_batch[0:len(nbr),count,0] = torch.from_numpy(nbr[:, 0])
-                    nbrs_batch[0:len(nbr), count, 1] = torch.from_numpy(nbr[:, 1])
-                    pos[0] = id % self.grid_size[0]
-                    pos[1] = id // self.grid_size[0]
-                    mask_batch[sampleId,pos[1],pos[0],:] = torch.ones(self.enc_size).byte()
-                    count+=1
 
-        return hist_batch, nbrs_batch, mask_batch, lat_enc_batch, lon_enc_batch, fut_batch, op_mask_batch
-
-#________________________________________________________________________________________________________________________________________
 
 
+## Zero padded (sequences, maxlen, width) float32 array of (length, width) sequences, and their lengths
+def pack_sequences(sequences, maxlen, width):
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    packed = np.zeros((len(sequences), maxlen, width), dtype=np.float32)
+    if lengths.any():
+        # Sequence and step of every row of the concatenated sequences
+        seq = np.repeat(np.arange(len(sequences)), lengths)
+        step = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        packed[seq, step] = np.concatenate([x for x in sequences if len(x)])
+    return packed, lengths
 
 
 
@@ -0,0 +1,638 @@
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from track_store import TrackTable
+
+#___________________________________________________________________________________________________________________________
+
+## Memory of a worker: chunks of parsed text, runs of vehicles labeled at once and frame ranges of the grid
+## construction are sized to fit. On top of it, the vehicle index of the recording being labeled (about 14 bytes
+## per row, see vehicle_index) is kept whole, as it is saved with the shard.
+memory_budget = 1 << 28  # bytes per worker (so num_workers * memory_budget in total)
+
+
+## CSR index of the rows of a recording
+def group_rows(keys, *within):
+    """
+    Group the rows of a recording by key with a single sort.
+
+    Returns (uniq, rows, off): the rows of the k-th key uniq[k] are rows[off[k]:off[k+1]], in file
+    order, or ordered by the optional within-group keys (most significant first).
+
+    Args:
+    - keys: Group key of every row (e.g. Vehicle ID or Frame ID).
+    - within: Optional keys ordering the rows inside each group.
+    """
+    if within:
+        rows = np.lexsort(tuple(reversed(within)) + (keys,))
+    else:
+        rows = np.argsort(keys, kind="stable")
+    sorted_keys = keys[rows]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]) if len(rows) else np.zeros(0, dtype=np.int64)
+    return sorted_keys[starts], rows, np.r_[starts, len(rows)]
+
+
+## Vehicle index: rows of every vehicle in file order
+def vehicle_index(t):
+    return group_rows(t[:, 1])
+
+
+## Frame index: rows of every frame ordered by lane and Local Y
+def frame_index(t):
+    return group_rows(t[:, 2], t[:, 5], t[:, 4])
+
+
+## Maneuver labeling windows, in frames (10 Hz)
+lat_window = 40  # lane change looked up 4 s before and after the current frame
+lon_hist = 30  # 3 s of history for the average past speed
+lon_fut = 50  # 5 s of future for the average future speed
+maneuver_row_bytes = 128  # peak bytes per row of a run of vehicles labeled at once, see memory_budget
+
+
+## Vectorized maneuver labeling
+def label_maneuvers(t, lat_col, lon_col, vehicles=None):
+    """
+    Write the lateral and longitudinal maneuver labels of every row of one recording.
+
+    Rows are taken per vehicle from the vehicle index (in file order) so that the +-4 s lateral and
+    -3 s/+5 s longitudinal windows become shifted-index lookups over whole tracks.
+    Labels are identical to the former per-row loop. Vehicles are labeled in runs whose rows fit
+    in memory_budget.
+
+    Args:
+    - t: Recording array (Dataset ID, Vehicle ID, Frame ID, Local X, Local Y, Lane ID, ...).
+    - lat_col: Column receiving the lateral maneuver (1: keep lane, 2: left, 3: right).
+    - lon_col: Column receiving the longitudinal maneuver (1: keep speed, 2: brake).
+    - vehicles: Vehicle index of t (see vehicle_index), built if not given.
+    """
+    if len(t) == 0:
+        return
+    if vehicles is None:
+        vehicles = vehicle_index(t)
+
+    # Runs of whole vehicles (at least one) whose rows fit in the memory budget
+    _, order, off = vehicles
+    max_rows = max(1, memory_budget // maneuver_row_bytes)
+    v = 0
+    while v < len(off) - 1:
+        stop = max(v + 1, int(np.searchsorted(off, off[v] + max_rows, side="right")) - 1)
+        _label_vehicles(t, lat_col, lon_col, order[off[v] : off[stop]], off[v : stop + 1] - off[v])
+        v = stop
+
+
+def _label_vehicles(t, lat_col, lon_col, order, off):
+    # Rows of each vehicle in file order, as one sorted run per vehicle
+    n = len(order)
+    veh = t[order, 1]
+    frame = t[order, 2]
+    counts = np.diff(off)
+    first = np.repeat(off[:-1], counts)
+    last = np.repeat(off[1:] - 1, counts)
+
+    # Position of the current frame in its track (first occurrence if a frame is repeated)
+    pos = np.arange(n)
+    by_frame = np.lexsort((pos, frame, veh))
+    new_frame = np.r_[True, (veh[by_frame][1:] != veh[by_frame][:-1]) | (frame[by_frame][1:] != frame[by_frame][:-1])]
+    ind = np.empty(n, dtype=np.int64)
+    ind[by_frame] = by_frame[np.flatnonzero(new_frame)][np.cumsum(new_frame) - 1]
+
+    # Get lateral maneuver
+    lane = t[order, 5]
+    ub = np.minimum(last, ind + lat_window)
+    lb = np.maximum(first, ind - lat_window)
+    right = (lane[ub] > lane[ind]) | (lane[ind] > lane[lb])
+    left = (lane[ub] < lane[ind]) | (lane[ind] < lane[lb])
+    lat = np.where(right, 3, np.where(left, 2, 1))
+
+    # Get longitudinal maneuver
+    y = t[order, 4].astype(np.float64)
+    ub = np.minimum(last, ind + lon_fut)
+    lb = np.maximum(first, ind - lon_hist)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        v_hist = (y[ind] - y[lb] + 1e-6) / (ind - lb + 1e-6)
+        v_fut = (y[ub] - y[ind] + 1e-6) / (ub - ind + 1e-6)
+        brake = v_fut / v_hist < 0.8
+    keep = (ub == ind) | (lb == ind)
+    lon = np.where(keep | ~brake, 1, 2)
+
+    t[order, lat_col] = lat
+    t[order, lon_col] = lon
+
+
+## Social grid: 13 cells of 15 ft per lane, for the left, current and right lane
+grid_cells = 13
+grid_range = 90  # neighbors are kept up to 90 ft ahead of and behind the ego vehicle
+grid_pair_bytes = 128  # bytes per (ego row, candidate neighbor row) pair of a pass, see memory_budget
+grid_row_bytes = 256  # peak bytes per row of a range of frames, besides its passes
+grid_scan_bytes = 32  # peak bytes per row of a block of the frame column, while the ranges are found
+
+
+## Vectorized social grid construction
+def build_grid(t, grid_col):
+    """
+    Write the 13x3 grid of neighbor vehicle IDs of every row of one recording.
+
+    The frame index orders vehicles by (frame, lane, Local Y), so the neighbors of each ego row in
+    the left, current and right lane are found with searchsorted instead of filtering the
+    frame in Python. Columns grid_col ... grid_col + 38 receive the same IDs as the former
+    update_grid loop (left lane cells first, and the last matching row of a frame wins a cell).
+    Neighbors never cross frames, so the recording is handled in ranges of frames whose rows fit in
+    half of memory_budget, and the ego rows of a range in passes whose candidate neighbor pairs fit
+    in the other half.
+
+    Args:
+    - t: Recording array (Dataset ID, Vehicle ID, Frame ID, Local X, Local Y, Lane ID, ...).
+    - grid_col: First of the 39 grid columns.
+    """
+    n = len(t)
+    if n == 0:
+        return
+
+    # Rows of every frame, counted over blocks of the frame column
+    block_rows = max(1, memory_budget // grid_scan_bytes)
+    blocks = range(0, n, block_rows)
+    first = int(min(t[start : start + block_rows, 2].min() for start in blocks))
+    last = int(max(t[start : start + block_rows, 2].max() for start in blocks))
+    counts = np.zeros(last - first + 1, dtype=np.int64)
+    for start in blocks:
+        counts += np.bincount(t[start : start + block_rows, 2].astype(np.int64) - first, minlength=len(counts))
+    ends = np.cumsum(counts)
+
+    # Ranges of whole frames (at least one) whose rows fit in half of the memory budget
+    max_rows = max(1, memory_budget // (2 * grid_row_bytes))
+    lo = 0
+    while lo < len(counts):
+        done = ends[lo - 1] if lo else 0
+        hi = max(lo + 1, int(np.searchsorted(ends, done + max_rows, side="right")))
+        rows = []
+        for start in blocks:
+            frame = t[start : start + block_rows, 2]
+            rows.append(start + np.flatnonzero((frame >= first + lo) & (frame < first + hi)))
+        _grid_rows(t, grid_col, np.concatenate(rows))
+        lo = hi
+
+
+def _grid_rows(t, grid_col, rows):
+    # Rows of a range of frames (in file order), indexed by frame
+    local = t[rows, :6]
+    n = len(local)
+    if n == 0:
+        return
+    _, order, off = frame_index(local)
+    frame = np.empty(n, dtype=np.int64)
+    frame[order] = np.repeat(np.arange(len(off) - 1), np.diff(off))
+    lane = local[:, 5].astype(np.int64)
+    y = local[:, 4].astype(np.float64)
+
+    # Search key of the frame index: one value per (frame, lane) pair with room for the lanes
+    # left and right of every vehicle, refined by the rank of Local Y
+    lane_min = lane.min() - 1
+    lane_span = lane.max() - lane_min + 2
+    y_uniq = np.unique(y)
+    rank_span = len(y_uniq) + 1
+    key = ((frame * lane_span + lane - lane_min) * rank_span + np.searchsorted(y_uniq, y))[order]
+
+    # Rows of the left, current and right lane within +-(grid_range + 1) ft of every ego row (exact test below)
+    lo_rank = np.searchsorted(y_uniq, y - grid_range - 1, side="left")
+    hi_rank = np.searchsorted(y_uniq, y + grid_range + 1, side="right")
+    bounds = []
+    for d in (-1, 0, 1):
+        group = (frame * lane_span + lane + d - lane_min) * rank_span
+        bounds.append((np.searchsorted(key, group + lo_rank, side="left"), np.searchsorted(key, group + hi_rank, side="left")))
+    del lo_rank, hi_rank, group
+
+    # Passes over runs of ego rows whose candidate pairs fit in half of the memory budget
+    pairs = np.cumsum(sum(hi - lo for lo, hi in bounds))
+    max_pairs = max(1, memory_budget // (2 * grid_pair_bytes))
+    start = 0
+    while start < n:
+        done = pairs[start - 1] if start else 0
+        stop = max(start + 1, int(np.searchsorted(pairs, done + max_pairs, side="right")))
+        ego = np.arange(start, stop)
+        egos, cands, cells = [], [], []
+        for side, (lo, hi) in enumerate(bounds):
+            lo = lo[start:stop]
+            counts = hi[start:stop] - lo
+            ego_rep = np.repeat(ego, counts)
+            cand = order[np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+            dy = y[cand] - y[ego_rep]
+            near = np.abs(dy) < grid_range
+            egos.append(ego_rep[near])
+            cands.append(cand[near])
+            cells.append(side * grid_cells + np.round((dy[near] + grid_range) / 15).astype(np.int64))
+        egos, cands, cells = np.concatenate(egos), np.concatenate(cands), np.concatenate(cells)
+
+        # Within a cell, the last neighbor row in file order wins
+        by_cell = np.lexsort((cands, cells, egos))
+        egos, cands, cells = egos[by_cell], cands[by_cell], cells[by_cell]
+        last = np.r_[(egos[1:] != egos[:-1]) | (cells[1:] != cells[:-1]), True]
+        t[rows[egos[last]], grid_col + cells[last]] = local[cands[last], 1]
+        start = stop
+
+
+## Train, validation and test split by vehicle ID
+def split_recording(t, vehicles, ratios=(0.7, 0.8)):
+    """
+    Split one recording into train, validation and test sets by vehicle ID.
+
+    Vehicles up to 70% of the largest ID go to train, up to 80% to validation and the rest to test.
+    Returns the row numbers (in file order) and the vehicle index restricted to each set; the index
+    slices share the rows array of the recording, so no set is sorted again, and the rows are only
+    gathered when the set is written (see save_store).
+    """
+    veh_ids, rows, off = vehicles
+    max_id = int(veh_ids[-1])
+    bounds = [int(r * max_id) for r in ratios]
+    cuts = np.r_[0, np.searchsorted(veh_ids, bounds, side="right"), len(veh_ids)]
+    part = np.searchsorted(bounds, t[:, 1], side="left")
+
+    sets = []
+    for k in range(len(cuts) - 1):
+        a, b = cuts[k], cuts[k + 1]
+        sets.append((np.flatnonzero(part == k), (veh_ids[a:b], rows, off[a : b + 1])))
+    return sets
+
+
+## Organize the tracks of every vehicle
+def create_tracks(traj_set, index_set, cols, dtype=np.float32):
+    """
+    Build the TrackTable of a split: the rows of every vehicle in the split, in one dense
+    array with a slot per vehicle that exists (no slots for unused vehicle IDs).
+
+    Args:
+    - traj_set: Recording arrays, one per dataset ID.
+    - index_set: Vehicle index of each recording (or of the split taken from it).
+    - cols: Columns kept in the tracks (Frame ID, Local X, Local Y, ...).
+    - dtype: Type of the track values.
+    """
+    max_veh_id = int(max([veh_ids.max() for veh_ids, _, _ in index_set if len(veh_ids)], default=0))
+    slots = np.full((len(traj_set), max_veh_id), -1, dtype=np.int32)
+    values, offsets = [], [np.zeros(1, dtype=np.int64)]
+    n_slots, n_rows = 0, 0
+
+    for ds_id, (traj, (veh_ids, rows, off)) in enumerate(zip(traj_set, index_set), start=1):
+        # The vehicles of a split are a contiguous run of the vehicle index of the recording
+        values.append(traj[np.ix_(rows[off[0] : off[-1]], cols)].astype(dtype))
+        offsets.append(off[1:] - off[0] + n_rows)
+        slots[ds_id - 1, veh_ids.astype(np.int64) - 1] = n_slots + np.arange(len(veh_ids))
+        n_slots += len(veh_ids)
+        n_rows += off[-1] - off[0]
+
+    return TrackTable(np.concatenate(values), np.concatenate(offsets), slots)
+
+
+## Per-recording shards written by the (parallel) labeling and grid stage
+#
+# A shard is <path>.npy, the labeled recording (memory-mapped when loaded), and <path>.npz, its
+# vehicle index.
+def save_shard(file, vehicles):
+    veh_ids, rows, off = vehicles
+    np.savez(file, veh_ids=veh_ids, rows=rows, off=off)
+
+
+def load_shard(path):
+    index = np.load(path + ".npz")
+    return np.load(path + ".npy", mmap_mode="r"), (index["veh_ids"], index["rows"], index["off"])
+
+
+## Bounded-memory ingestion
+#
+# Input files are parsed in chunks that fit in memory_budget and streamed to the parsed cache, and
+# the labeled recording is built in its memory-mapped shard, so a worker holds one chunk of text
+# and a few index arrays (tens of bytes per row) instead of whole DataFrames and float64 copies.
+ingest_row_bytes = 1 << 10  # peak bytes per row while pandas parses a chunk of an NGSIM file
+
+
+def read_chunks(file, budget=None, **read_csv_args):
+    """
+    Read a text file with pd.read_csv in chunks of DataFrames that fit in the memory budget.
+
+    Args:
+    - file: Input file.
+    - budget: Bytes for one chunk (memory_budget if not given).
+    - read_csv_args: Arguments of pd.read_csv (separator, column names...).
+    """
+    budget = memory_budget if budget is None else budget
+    return pd.read_csv(file, chunksize=max(1, budget // ingest_row_bytes), **read_csv_args)
+
+
+def save_blocks(f, blocks):
+    """
+    Write (rows, columns) blocks one after another to an open file, as a single .npy array.
+
+    Only one block is held at a time: the header is rewritten with the final number of rows
+    (numpy pads .npy headers so that they can grow in place).
+    """
+    header, n = None, 0
+    for block in blocks:
+        block = np.ascontiguousarray(block)
+        if header is None:
+            start = f.tell()
+            header = {"descr": np.lib.format.dtype_to_descr(block.dtype), "fortran_order": False, "shape": block.shape}
+            np.lib.format.write_array_header_1_0(f, header)
+            data_start = f.tell()
+        f.write(block.data)
+        n += len(block)
+    if header is None:
+        np.save(f, np.zeros((0, 0), dtype=np.float32))
+        return
+    end = f.tell()
+    f.seek(start)
+    np.lib.format.write_array_header_1_0(f, dict(header, shape=(n,) + header["shape"][1:]))
+    if f.tell() != data_start:
+        raise RuntimeError("the .npy header did not keep its size")
+    f.seek(end)
+
+
+## Binary column cache of the raw NGSIM text files
+#
+# The first read of a trajectories-*.txt file converts it to <file>.columns/: one flat binary file
+# per column (types below) and a header.json with the number of rows and the size and modification
+# time of the text file. Later reads memory-map the columns instead of parsing the text again; the
+# cache is rebuilt when the text file changes size or modification time.
+ngsim_columns = [
+    ("Vehicle_ID", "int32"),
+    ("Frame_ID", "int32"),
+    ("Total_Frames", "int32"),
+    ("Global_Time", "int64"),
+    ("Local_X", "float32"),
+    ("Local_Y", "float32"),
+    ("Global_X", "float64"),  # state plane coordinates (~6e6 ft) need float64 for their decimals
+    ("Global_Y", "float64"),
+    ("v_Length", "float32"),
+    ("v_Width", "float32"),
+    ("v_Class", "int32"),
+    ("v_Vel", "float32"),
+    ("v_Acc", "float32"),
+    ("Lane_ID", "int32"),
+    ("Preceding", "int32"),
+    ("Following", "int32"),
+    ("Space_Headway", "float32"),
+    ("Time_Headway", "float32"),
+]
+column_cache_version = 1
+
+
+def ngsim_table(file):
+    """
+    Columns of a raw NGSIM text file, as {column name: memory-mapped array}, converting the file to
+    its binary column cache first if needed.
+
+    Args:
+    - file: Raw NGSIM trajectory file (whitespace-delimited, no header).
+    """
+    path = file + ".columns"
+    stat = os.stat(file)
+    header = None
+    if os.path.exists(os.path.join(path, "header.json")):
+        with open(os.path.join(path, "header.json")) as f:
+            header = json.load(f)
+    if header is None or (header["version"], header["size"], header["mtime_ns"]) != (column_cache_version, stat.st_size, stat.st_mtime_ns):
+        header = _convert_ngsim(file, path, stat)
+
+    table = {}
+    for name, dtype in ngsim_columns:
+        if header["rows"] == 0:
+            table[name] = np.zeros(0, dtype=dtype)
+        else:
+            table[name] = np.memmap(os.path.join(path, name + ".bin"), dtype=dtype, mode="r", shape=(header["rows"],))
+    return table
+
+
+def _convert_ngsim(file, path, stat):
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    names = [name for name, _ in ngsim_columns]
+    outs = [open(os.path.join(tmp, name + ".bin"), "wb") for name in names]
+    rows = 0
+    try:
+        for chunk in read_chunks(file, sep=r"\s+", header=None, names=names):
+            for out, (name, dtype) in zip(outs, ngsim_columns):
+                out.write(np.ascontiguousarray(chunk[name].to_numpy(dtype=dtype)).data)
+            rows += len(chunk)
+    finally:
+        for out in outs:
+            out.close()
+
+    header = {"version": column_cache_version, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "rows": rows}
+    with open(os.path.join(tmp, "header.json"), "w") as f:
+        json.dump(header, f, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+    return header
+
+
+def ngsim_blocks(file, columns, dataset_id, budget=None):
+    """
+    Selected columns of a raw NGSIM file (from its column cache) as float32 row blocks that fit in
+    the memory budget.
+
+    Args:
+    - file: Raw NGSIM trajectory file.
+    - columns: Column names; "DatasetId" is a column holding dataset_id.
+    - dataset_id: Dataset ID of the recording.
+    - budget: Bytes for one block (memory_budget if not given).
+    """
+    table = ngsim_table(file)
+    n = len(table["Vehicle_ID"])
+    block_rows = max(1, (memory_budget if budget is None else budget) // (4 * len(columns)))
+    for start in range(0, n, block_rows):
+        stop = min(n, start + block_rows)
+        t = np.empty((stop - start, len(columns)), dtype=np.float32)
+        for k, name in enumerate(columns):
+            t[:, k] = dataset_id if name == "DatasetId" else table[name][start:stop]
+        yield t
+
+
+## Content-hashed cache of the per-recording stages
+#
+# Each recording goes through three cached stages:
+#   parsed-<key>.npy   - selected columns of the input file, key = hash of the file content and of
+#                        the column selection
+#   labeled-<key>.npy  - labels and grid (a shard, with its vehicle index in labeled-<key>.npz),
+#                        key = parsed key and the labeling and grid parameters
+#   weather-<key>.npz  - weather records and the record of every row, key = hash of the input and
+#                        weather files and of the weather columns
+# A re-run rebuilds only the stages whose key changed; the split and the tracks are always rebuilt
+# from the shards. Bump cache_version when the code of a stage changes.
+cache_version = 2
+
+
+def file_digest(path, chunk_size=1 << 24):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_key(*parts):
+    return hashlib.sha256(repr((cache_version,) + parts).encode()).hexdigest()[:20]
+
+
+## Parameters the labels and grids depend on
+def stage_params():
+    return {
+        "lat_window": lat_window,
+        "lon_hist": lon_hist,
+        "lon_fut": lon_fut,
+        "grid_cells": grid_cells,
+        "grid_range": grid_range,
+    }
+
+
+def _write_atomic(path, write):
+    # Concurrent workers never see a partially written artifact
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+## Parsed, labeled and gridded recording, rebuilt only when stale
+def cached_recording(cache_dir, file, load, parse_params, label_cols):
+    """
+    Return the path of the labeled shard of a recording (see load_shard), running only the stale stages.
+
+    Args:
+    - cache_dir: Directory of the cached artifacts.
+    - file: Input file of the recording.
+    - load: Function parsing the file into the float32 recording array (Dataset ID, Vehicle ID,
+      Frame ID, Local X, Local Y, Lane ID, ...), or into an iterable of row blocks of it.
+    - parse_params: Everything besides the file content that load depends on (dataset ID, columns...).
+    - label_cols: (lateral column, longitudinal column, first grid column).
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    parse_key = cache_key(file_digest(file), parse_params)
+    shard = os.path.join(cache_dir, "labeled-%s" % cache_key(parse_key, label_cols, stage_params()))
+    if os.path.exists(shard + ".npz"):
+        return shard
+
+    parsed = os.path.join(cache_dir, "parsed-%s.npy" % parse_key)
+    if not os.path.exists(parsed):
+        blocks = load(file)
+        _write_atomic(parsed, lambda f: save_blocks(f, [blocks] if isinstance(blocks, np.ndarray) else blocks))
+    parsed = np.load(parsed, mmap_mode="r")
+
+    # Create empty columns for future (2 for behaviors, 13 * 3 for spatial grid), in a memory-mapped
+    # float32 array: the labels and grid are computed in float64 from it and stored exactly
+    tmp = "%s.npy.%d.tmp" % (shard, os.getpid())
+    t = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(len(parsed), parsed.shape[1] + 2 + grid_cells * 3))
+    block_rows = max(1, memory_budget // (4 * t.shape[1]))
+    for start in range(0, len(t), block_rows):
+        t[start : start + block_rows, : parsed.shape[1]] = parsed[start : start + block_rows]
+
+    # Index the rows of every vehicle and frame once (one sort per key)
+    vehicles = vehicle_index(t)
+
+    # Get lateral and longitudinal maneuvers for all rows at once
+    label_maneuvers(t, label_cols[0], label_cols[1], vehicles)
+
+    # Populate grid locations, over ranges of frames
+    build_grid(t, label_cols[2])
+
+    t.flush()
+    del t
+    os.replace(tmp, shard + ".npy")
+    _write_atomic(shard + ".npz", lambda f: save_shard(f, vehicles))
+    return shard
+
+
+## As-of join of the hourly weather records onto the rows of a recording
+weather_utc_offset = 7  # hours between the Global Time of the recordings (UTC) and the local time of the weather files
+
+
+def load_weather(weather_file, weather_columns):
+    """
+    Weather records of a weather file, sorted by time.
+
+    Returns (times, values): the record times (int64 ms since epoch, local time) and the float32
+    (records, weather columns) values.
+
+    Args:
+    - weather_file: Weather CSV (Visual Crossing export, one record per hour, local time).
+    - weather_columns: Weather columns to load (e.g. ["precip", "windspeed", "visibility"]).
+    """
+    weather_columns = list(weather_columns)
+    weather = pd.read_csv(weather_file, usecols=["datetime"] + weather_columns)
+    times = pd.to_datetime(weather["datetime"]).to_numpy(dtype="datetime64[ms]").astype(np.int64)
+    order = np.argsort(times, kind="stable")
+    return times[order], weather[weather_columns].to_numpy(dtype=np.float32)[order]
+
+
+def weather_index(global_time, times):
+    """
+    Weather record of every row: the last record at or before the time of the row (-1 before the
+    first record), found with one searchsorted on int64 timestamps.
+
+    Args:
+    - global_time: Global Time of every row (ms since epoch).
+    - times: Sorted record times (ms since epoch, local time), see load_weather.
+    """
+    local_time = np.asarray(global_time, dtype=np.int64) - weather_utc_offset * 3600 * 1000
+    return (np.searchsorted(times, local_time, side="right") - 1).astype(np.int32)
+
+
+def weather_rows(index, values):
+    # Weather values of every row (NaN before the first record)
+    w = values[np.maximum(index, 0)]
+    w[index < 0] = np.nan
+    return w
+
+
+def join_weather(global_time, weather_file, weather_columns):
+    """
+    Weather of every row: the values of the last weather record at or before the time of the row.
+
+    Args:
+    - global_time: Global Time of every row (ms since epoch).
+    - weather_file: Weather CSV of the recording.
+    - weather_columns: Weather columns to join.
+    """
+    times, values = load_weather(weather_file, weather_columns)
+    return weather_rows(weather_index(global_time, times), values)
+
+
+def cached_weather(cache_dir, file, load_times, weather_file, weather_columns):
+    """
+    Return the path of the weather of a recording: an .npz holding "index", the weather record of
+    every row (in file order, see weather_index), and "values", the (records, weather columns)
+    weather records.
+
+    Args:
+    - cache_dir: Directory of the cached artifacts.
+    - file: Input file of the recording.
+    - load_times: Function parsing the Global Time of every row of the file.
+    - weather_file: Weather CSV of the recording.
+    - weather_columns: Weather columns to join.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = cache_key(file_digest(file), file_digest(weather_file), list(weather_columns), weather_utc_offset)
+    path = os.path.join(cache_dir, "weather-%s.npz" % key)
+    if not os.path.exists(path):
+        times, values = load_weather(weather_file, weather_columns)
+        index = weather_index(load_times(file), times)
+        _write_atomic(path, lambda f: np.savez(f, index=index, values=values))
+    return path
+
+
+## Run the per-recording stage, one process per recording
+def process_recordings(process_recording, n_recordings, num_workers=0):
+    """
+    Call process_recording(i) for every recording and return the results in recording order.
+
+    Recordings are independent until they are split and merged, so with num_workers > 0 each one
+    is handled in its own process (process_recording must be a module-level function and the
+    calling script must be guarded by if __name__ == "__main__"). num_workers = 0 runs them here.
+    """
+    if num_workers > 0:
+        with ProcessPoolExecutor(max_workers=min(num_workers, n_recordings)) as pool:
+            return list(pool.map(process_recording, range(n_recordings)))
+    return [process_recording(i) for i in range(n_recordings)]
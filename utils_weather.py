@@ -1,27 +1,36 @@
 from __future__ import print_function, division
-from torch.utils.data import Dataset, DataLoader
-import scipy.io as scp
+from torch.utils.data import Dataset, DataLoader, Sampler
 import numpy as np
 import torch
+import torch.multiprocessing
+import queue
+import traceback
+from track_store import (TrackStore, TrackTable, open_split, history_rows, future_rows, save_arrays,
+                         open_arrays, store_stamp)
 
 #___________________________________________________________________________________________________________________________
 
+## Weather feature sets of the experiments (columns of the weather files)
+weather_feature_sets = {
+    0: [],
+    3: ["precip", "windspeed", "visibility"],
+    5: ["temp", "humidity", "precip", "windspeed", "visibility"],
+}
+
 ### Dataset class for the NGSIM dataset
 class ngsimDataset(Dataset):
 
 
-    def __init__(self, mat_file, t_h=30, t_f=50, d_s=2, enc_size = 64, grid_size = (13,3)):
+    def __init__(self, mat_file, t_h=30, t_f=50, d_s=2, enc_size = 64, grid_size = (13,3), weather_features=3):
         # self.D = scp.loadmat(mat_file)['traj']
         # self.T = scp.loadmat(mat_file)['tracks']
 
-        if mat_file[-3:] == "mat":
-            self.D = scp.loadmat(mat_file)["traj"]
-            self.T = scp.loadmat(mat_file)["tracks"]
-        else:
-            self.D = np.load(mat_file, allow_pickle=True)
-            self.T = np.load(mat_file, allow_pickle=True)
-            self.D = self.D.item()["traj"]
-            self.T = self.T.item()["tracks"]
+        # Track store (pickled .npy / .mat splits are converted to one on first use): memory-mapped, so
+        # DataLoader workers share its pages instead of holding a copy of the split each
+        self.mat_file = mat_file
+        self.store = open_split(mat_file)
+        self.D = self.store.traj
+        self.T = self.store.tracks
 
         self.t_h = t_h  # length of track history
         self.t_f = t_f  # length of predicted trajectory
@@ -29,19 +38,62 @@ class ngsimDataset(Dataset):
         self.enc_size = enc_size # size of encoder LSTM
         self.grid_size = grid_size # size of social context grid
 
+        # Samples with a full history and a future for this (t_h, t_f, d_s); the others would only be padded
+        # with zeros. Derived from the tracks (which hold every frame) and cached in the store per configuration
+        self.index = self.store.sample_index(t_h, t_f, d_s)
+
+        # Samples: Dataset ID, Vehicle ID, Frame ID, Local X, Local Y, Lane ID, [weather], lateral and
+        # longitudinal maneuver, grid. Splits saved with weather columns in the samples are still read.
+        self.label_col = self.D.shape[1] - 2 - grid_size[0] * grid_size[1]
+
+        # Weather features, picked by name (or by size, see weather_feature_sets) when the split is opened
+        if isinstance(weather_features, int):
+            weather_features = weather_feature_sets[weather_features]
+        self.weather_features = list(weather_features)
+        self.weather_size = len(self.weather_features)
+        self.setWeather()
+
+
+
+    ## Weather of the track rows (same rows as the tracks) and the columns of the selected features
+    #
+    # self.W holds the weather record of every track row, gathered from self.weather_table (the
+    # selected features of every record), or, when self.weather_table is None, the weather itself
+    # (columns self.weather_cols).
+    def setWeather(self):
+        self.weather_table = None
+        if self.store is not None and self.store.weather_table is not None:
+            missing = [f for f in self.weather_features if f not in self.store.weather_columns]
+            if missing:
+                raise ValueError("%s: no weather columns %s" % (self.mat_file, missing))
+            self.weather_cols = [self.store.weather_columns.index(f) for f in self.weather_features]
+            if self.store.weather_index is not None:
+                self.W = TrackTable(self.store.weather_index, self.T.offsets, self.T.slots)
+                self.weather_table = self.store.weather_table[:, self.weather_cols]
+            else:
+                self.W = TrackTable(self.store.weather_table, self.T.offsets, self.T.slots)
+        else:
+            # Older splits carry their weather features as the last columns of the tracks
+            n_cols = self.T.values.shape[1]
+            if self.weather_size > n_cols - 3:
+                raise ValueError("%s: has only %d weather columns" % (self.mat_file, n_cols - 3))
+            self.W = self.T
+            self.weather_cols = list(range(n_cols - self.weather_size, n_cols))
+
 
 
     def __len__(self):
-        return len(self.D)
+        return len(self.index)
 
 
 
     def __getitem__(self, idx):
+        idx = self.index[idx]
 
         dsId = self.D[idx, 0].astype(int)
         vehId = self.D[idx, 1].astype(int)
         t = self.D[idx, 2]
-        grid = self.D[idx,8+3:]
+        grid = self.D[idx,self.label_col+2:]
         neighbors = []
 
         # Get track history 'hist' = ndarray, and future track 'fut' = ndarray
@@ -55,114 +107,666 @@ class ngsimDataset(Dataset):
 
         # Maneuvers 'lon_enc' = one-hot vector, 'lat_enc = one-hot vector
         lon_enc = np.zeros([2])
-        lon_enc[int(self.D[idx, 7+3] - 1)] = 1
+        lon_enc[int(self.D[idx, self.label_col+1] - 1)] = 1
         lat_enc = np.zeros([3])
-        lat_enc[int(self.D[idx, 6+3] - 1)] = 1
+        lat_enc[int(self.D[idx, self.label_col] - 1)] = 1
 
         return hist,weather,fut,neighbors,lat_enc,lon_enc
 
 
+    ## Batched fetch, called by DataLoader with the indices of a batch instead of __getitem__
+    def __getitems__(self, indices):
+        """
+        Samples of a batch as arrays, gathered from the tracks with one fancy index per window
+        (same values as __getitem__); collate_fn turns them into the batch tensors.
+
+        Returns a dict of:
+        - hist, weather: (samples, t_h // d_s + 1, ...) histories.
+        - fut, fut_len: (samples, t_f // d_s, 2) futures (zero padded) and their lengths.
+        - nbrs: (neighbors, t_h // d_s + 1, 2) neighbor histories, in (sample, grid cell) order.
+        - nbr_sample, nbr_cell: Sample and grid cell of every neighbor.
+        - lat_enc, lon_enc: (samples, 3) and (samples, 2) one-hot maneuvers.
+        """
+        samples = self.D[self.index[np.asarray(indices, dtype=np.int64)]]
+        dsIds = samples[:, 0].astype(np.int64)
+        t = samples[:, 2]
+        grid = samples[:, self.label_col+2:].astype(np.int64)
+
+        # Ego history and future, relative to the ego position at frame t
+        k = self.T.slots_of(dsIds, samples[:, 1])
+        row = self.T.frame_rows(k, t)
+        refPos = self.T.values[row, 1:3]
+        rows, full = history_rows(self.T, k, row, self.t_h, self.d_s)
+        hist = np.where(full[:, None, None], self.T.values[rows, 1:3] - refPos[:, None], 0)
+        weather = self.W.values[rows]
+        if self.weather_table is not None:
+            weather = self.weather_table[weather]
+        else:
+            weather = weather[..., self.weather_cols]
+        weather = np.where(full[:, None, None], weather, 0)
+        rows, fut_len = future_rows(self.T, k, row, self.t_f, self.d_s)
+        fut = self.T.values[rows, 1:3] - refPos[:, None]
+        fut[np.arange(fut.shape[1]) >= fut_len[:, None]] = 0
+
+        # Neighbor histories with a full history, in (sample, grid cell) order
+        nbr_k = self.T.slots_of(np.repeat(dsIds, grid.shape[1]), grid.ravel())
+        nbr_row = self.T.frame_rows(nbr_k, np.repeat(t, grid.shape[1]))
+        rows, full = history_rows(self.T, nbr_k, nbr_row, self.t_h, self.d_s)
+        nbr_sample, nbr_cell = np.divmod(np.flatnonzero(full), grid.shape[1])
+        nbrs = self.T.values[rows[full], 1:3] - refPos[nbr_sample, None]
+
+        # Maneuvers (one-hot)
+        lat_enc = np.eye(3)[samples[:, self.label_col].astype(np.int64) - 1]
+        lon_enc = np.eye(2)[samples[:, self.label_col+1].astype(np.int64) - 1]
+
+        return {"hist": hist, "weather": weather, "fut": fut, "fut_len": fut_len, "nbrs": nbrs,
+                "nbr_sample": nbr_sample, "nbr_cell": nbr_cell, "lat_enc": lat_enc, "lon_enc": lon_enc}
+
+
+
+    ## Helper function to get the track of a vehicle as rows (Frame ID, Local X, Local Y, ...), None if absent
+    def getTrack(self, vehId, dsId):
+        return self.T.track(dsId, vehId)
+
+
+
+    ## Reopen the memory maps instead of pickling the arrays (DataLoader workers started with spawn)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["store"], state["D"], state["T"], state["W"] = self.store.path, None, None, None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.store = TrackStore(self.store)
+        self.D = self.store.traj
+        self.T = self.store.tracks
+        self.setWeather()
+
+
 
     ## Helper function to get track history
     def getHistory(self,vehId,t,refVehId,dsId):
         if vehId == 0:
-            return np.empty([0,2]), np.empty([0,3])
+            return np.empty([0,2]), np.empty([0,self.weather_size])
+        # Track slots and rows of frame t (constant time, see TrackTable.frame_row)
+        refSlot = self.T.slot(dsId, refVehId)
+        vehSlot = self.T.slot(dsId, vehId)
+        if refSlot < 0 or vehSlot < 0:
+            return np.empty([0,2]), np.empty([0,self.weather_size])
+        refRow = self.T.frame_row(refSlot, t)
+        vehRow = self.T.frame_row(vehSlot, t)
+        if refRow < 0 or vehRow < 0:
+            return np.empty([0,2]), np.empty([0,self.weather_size])
+
+        refPos = self.T.values[refRow, 1:3]
+        stpt = max(int(self.T.offsets[vehSlot]), vehRow - self.t_h)
+        enpt = vehRow + 1
+        hist = self.T.values[stpt:enpt:self.d_s, 1:3] - refPos
+        weather = self.W.values[stpt:enpt:self.d_s]
+        if self.weather_table is not None:
+            weather = self.weather_table[weather]
         else:
-            if self.T.shape[1]<=vehId-1:
-                return np.empty([0,2]),np.empty([0,3])
-            # refTrack = self.T[dsId-1][refVehId-1].transpose()
-            # vehTrack = self.T[dsId-1][vehId-1].transpose()
-            ## Updated ##
-            refTrack = self.T[dsId - 1][refVehId - 1]
-            vehTrack = self.T[dsId - 1][vehId - 1]
-
-            if refTrack is None or vehTrack is None:
-                return np.empty([0, 2]), np.empty([0,3])
-
-            refTrack = refTrack.transpose()
-            vehTrack = vehTrack.transpose()
-            ##
-            refPos = refTrack[np.where(refTrack[:,0]==t)][0,1:3]
-
-            if vehTrack.size==0 or np.argwhere(vehTrack[:, 0] == t).size==0:
-                 return np.empty([0,2]), np.empty([0,3])
-            else:
-                stpt = np.maximum(0, np.argwhere(vehTrack[:, 0] == t).item() - self.t_h)
-                enpt = np.argwhere(vehTrack[:, 0] == t).item() + 1
-                hist = vehTrack[stpt:enpt:self.d_s,1:3]-refPos#get future
-                weather = vehTrack[stpt:enpt:self.d_s,-3:]
-            if len(hist) < self.t_h//self.d_s + 1:
-                return np.empty([0,2]), np.empty([0,3])
-            return hist, weather
-        
+            weather = weather[:, self.weather_cols]
+        if len(hist) < self.t_h//self.d_s + 1:
+            return np.empty([0,2]), np.empty([0,self.weather_size])
+        return hist, weather
 
 
 
     ## Helper function to get track future
     def getFuture(self, vehId, t,dsId):
-        vehTrack = self.T[dsId-1][vehId-1].transpose()
-        refPos = vehTrack[np.where(vehTrack[:, 0] == t)][0, 1:3]
-        stpt = np.argwhere(vehTrack[:, 0] == t).item() + self.d_s
-        enpt = np.minimum(len(vehTrack), np.argwhere(vehTrack[:, 0] == t).item() + self.t_f + 1)
-        fut = vehTrack[stpt:enpt:self.d_s,1:3]-refPos
+        vehSlot = self.T.slot(dsId, vehId)
+        vehRow = self.T.frame_row(vehSlot, t)
+        refPos = self.T.values[vehRow, 1:3]
+        stpt = vehRow + self.d_s
+        enpt = min(int(self.T.offsets[vehSlot + 1]), vehRow + self.t_f + 1)
+        fut = self.T.values[stpt:enpt:self.d_s, 1:3] - refPos
         return fut
 
 
 
     ## Collate function for dataloader
     def collate_fn(self, samples):
+        if isinstance(samples, dict):
+            return self.collate_batch(samples)
 
-        # Initialize neighbors and neighbors length batches:
-        nbr_batch_size = 0
-        for _,_,_,nbrs,_,_ in samples:
-            nbr_batch_size += sum([len(nbrs[i])!=0 for i in range(len(nbrs))])
+        # Pack the samples of __getitem__ into the arrays of __getitems__
         maxlen = self.t_h//self.d_s + 1
-        nbrs_batch = torch.zeros(maxlen,nbr_batch_size,2)
+        hist, weather, fut, nbrs, lat_enc, lon_enc = zip(*samples)
+        fut, fut_len = pack_sequences(fut, self.t_f//self.d_s, 2)
+
+        # Neighbors with a history, in (sample, grid cell) order
+        n_cells = self.grid_size[0] * self.grid_size[1]
+        nbrs = [nbr for sample_nbrs in nbrs for nbr in sample_nbrs]
+        occupied = np.flatnonzero(np.fromiter(map(len, nbrs), dtype=np.int64, count=len(nbrs)))
+        nbr_sample, nbr_cell = np.divmod(occupied, n_cells)
+
+        batch = {
+            "hist": pack_sequences(hist, maxlen, 2)[0],
+            "weather": pack_sequences(weather, maxlen, self.weather_size)[0],
+            "fut": fut,
+            "fut_len": fut_len,
+            "nbrs": pack_sequences([nbrs[i] for i in occupied], maxlen, 2)[0],
+            "nbr_sample": nbr_sample,
+            "nbr_cell": nbr_cell,
+            "lat_enc": np.array(lat_enc, dtype=np.float32).reshape(-1, 3),
+            "lon_enc": np.array(lon_enc, dtype=np.float32).reshape(-1, 2),
+        }
+        return self.collate_batch(batch)
+
+
+
+    ## Batch tensors (same as collate_fn) from the arrays of __getitems__
+    def collate_batch(self, batch):
+        n_fut = self.t_f//self.d_s
+        hist_batch = torch.from_numpy(np.ascontiguousarray(batch["hist"].transpose(1, 0, 2), dtype=np.float32))
+        weather_batch = torch.from_numpy(np.ascontiguousarray(batch["weather"].transpose(1, 0, 2), dtype=np.float32))
+        nbrs_batch = torch.from_numpy(np.ascontiguousarray(batch["nbrs"].transpose(1, 0, 2), dtype=np.float32))
+        fut_batch = torch.from_numpy(np.ascontiguousarray(batch["fut"].transpose(1, 0, 2), dtype=np.float32))
+        op_mask = np.arange(n_fut)[:, None] < batch["fut_len"][None, :]
+        op_mask_batch = torch.from_numpy(np.repeat(op_mask[:, :, None], 2, axis=2).astype(np.float32))
+        lat_enc_batch = torch.from_numpy(batch["lat_enc"].astype(np.float32))
+        lon_enc_batch = torch.from_numpy(batch["lon_enc"].astype(np.float32))
+
+        # Social mask: occupancy of the grid cell (id % 13, id // 13) of every neighbor (the model scatters the
+        # neighbor encodings into the occupied cells)
+        mask_batch = torch.zeros(len(batch["hist"]), self.grid_size[1], self.grid_size[0], dtype=torch.bool)
+        cell = torch.from_numpy(batch["nbr_cell"])
+        mask_batch[torch.from_numpy(batch["nbr_sample"]), cell // self.grid_size[0], cell % self.grid_size[0]] = True
 
+        return hist_batch, weather_batch, nbrs_batch, mask_batch, lat_enc_batch, lon_enc_batch, fut_batch, op_mask_batch
 
-        # Initialize social mask batch:
-        pos = [0, 0]
-        mask_batch = torch.zeros(len(samples), self.grid_size[1],self.grid_size[0],self.enc_size)
-        mask_batch = mask_batch.byte()
+## Export the samples of a dataset once as fixed-shape arrays, served by materializedDataset
+#
+# A materialized split is a directory of flat binary arrays (see track_store.save_arrays), one row per
+# sample of the dataset (in the order of its index):
+#   hist, weather - float32 (samples, t_h // d_s + 1, 2 / weather features) history and its weather
+#   fut, fut_len  - float32 (samples, t_f // d_s, 2) future (zero padded) and int16 its length
+#   lat, lon      - int8 lateral and longitudinal maneuver classes
+#   nbrs, nbr_cell, nbr_offsets - neighbor histories in CSR form: float32 (neighbors, t_h // d_s + 1, 2)
+#                   histories and int8 grid cells, sample i owning rows nbr_offsets[i]:nbr_offsets[i + 1]
+# The header records t_h, t_f, d_s, the grid size and the weather features the samples were built with,
+# and the track store they were read from (its version and the size and modification time of its traj.bin
+# and tracks.bin, see track_store.store_stamp): a split materialized from a store since rebuilt is stale.
+materialized_version = 2
+
+
+def materialize(dataset, path, chunk_size=8192):
+    """
+    Run an ngsimDataset once and write its samples to a materialized split.
+
+    Args:
+    - dataset: ngsimDataset (its t_h, t_f, d_s and weather features are kept).
+    - path: Directory of the materialized split.
+    - chunk_size: Samples gathered (with __getitems__) and written at a time.
+    """
+    dtypes = {"hist": np.float32, "weather": np.float32, "fut": np.float32, "fut_len": np.int16, "lat": np.int8,
+              "lon": np.int8, "nbrs": np.float32, "nbr_cell": np.int8, "nbr_offsets": np.int64}
+
+    def blocks():
+        n_nbrs = 0
+        yield {"nbr_offsets": np.zeros(1)}
+        for start in range(0, len(dataset), chunk_size):
+            batch = dataset.__getitems__(np.arange(start, min(start + chunk_size, len(dataset))))
+            count = np.bincount(batch["nbr_sample"], minlength=len(batch["hist"]))
+            yield {"hist": batch["hist"], "weather": batch["weather"], "fut": batch["fut"], "fut_len": batch["fut_len"],
+                   "lat": batch["lat_enc"].argmax(1), "lon": batch["lon_enc"].argmax(1), "nbrs": batch["nbrs"],
+                   "nbr_cell": batch["nbr_cell"], "nbr_offsets": n_nbrs + np.cumsum(count)}
+            n_nbrs += int(count.sum())
+
+    save_arrays(path, blocks(), dtypes, version=materialized_version, samples=len(dataset), t_h=dataset.t_h,
+                t_f=dataset.t_f, d_s=dataset.d_s, grid_size=list(dataset.grid_size),
+                weather_features=dataset.weather_features, source=store_stamp(dataset.store.path))
+
+
+
+### Dataset class for materialized splits: batches are slices of memory-mapped arrays
+class materializedDataset(Dataset):
+    """
+    Serves the samples written by materialize. The split is refused when the track store it was read
+    from was rebuilt (or is gone) since: it would otherwise serve the samples of the old store.
+
+    Args:
+    - path: Directory of the materialized split.
+    - check_source: Whether to compare the track store with the one recorded at materialization (False
+      opens a split copied without its track store).
+    """
+
+    def __init__(self, path, check_source=True):
+        self.path = path
+        self.header, self.arrays = open_arrays(path)
+        if self.header["version"] != materialized_version:
+            raise ValueError("%s: unsupported materialized split version %s, materialize it again"
+                             % (path, self.header["version"]))
+        if check_source:
+            source = self.header["source"]
+            try:
+                current = store_stamp(source["path"])
+            except OSError:
+                current = None
+            if current != source:
+                raise ValueError("%s: its track store %s changed or is gone since it was materialized, materialize "
+                                 "it again" % (path, source["path"]))
+        self.t_h = self.header["t_h"]
+        self.t_f = self.header["t_f"]
+        self.d_s = self.header["d_s"]
+        self.grid_size = tuple(self.header["grid_size"])
+        self.weather_features = self.header["weather_features"]
+        self.weather_size = len(self.weather_features)
 
 
-        # Initialize history, history lengths, future, output mask, lateral maneuver and longitudinal maneuver batches:
-        hist_batch = torch.zeros(maxlen,len(samples),2)
-        weather_batch = torch.zeros(maxlen,len(samples),3)
-        fut_batch = torch.zeros(self.t_f//self.d_s,len(samples),2)
-        op_mask_batch = torch.zeros(self.t_f//self.d_s,len(samples),2)
-        lat_enc_batch = torch.zeros(len(samples),3)
-        lon_enc_batch = torch.zeros(len(samples), 2)
 
+    def __len__(self):
+        return self.header["samples"]
 
-        count = 0
-        for sampleId,(hist, weather, fut, nbrs, lat_enc, lon_enc) in enumerate(samples):
-
-            # Set up history, future, lateral maneuver and longitudinal maneuver batches:
-            hist_batch[0:len(hist),sampleId,0] = torch.from_numpy(hist[:, 0])
-            hist_batch[0:len(hist), sampleId, 1] = torch.from_numpy(hist[:, 1])
-            weather_batch[0:len(weather), sampleId, 0] = torch.from_numpy(weather[:, 0])
-            weather_batch[0:len(weather), sampleId, 1] = torch.from_numpy(weather[:, 1])
-            weather_batch[0:len(weather), sampleId, 2] = torch.from_numpy(weather[:, 2])
-            fut_batch[0:len(fut), sampleId, 0] = torch.from_numpy(fut[:, 0])
-            fut_batch[0:len(fut), sampleId, 1] = torch.from_numpy(fut[:, 1])
-            op_mask_batch[0:len(fut),sampleId,:] = 1
-            lat_enc_batch[sampleId,:] = torch.from_numpy(lat_enc)
-            lon_enc_batch[sampleId, :] = torch.from_numpy(lon_enc)
-
-            # Set up neighbor, neighbor sequence length, and mask batches:
-            for id,nbr in enumerate(nbrs):
-                if len(nbr)!=0:
-                    # print(nbr)
-                    # print(np.shape(nbr))
-                    nbrs_batch[0:len(nbr),count,0] = torch.from_numpy(nbr[:, 0])
-                    nbrs_batch[0:len(nbr), count, 1] = torch.from_numpy(nbr[:, 1])
-                    pos[0] = id % self.grid_size[0]
-                    pos[1] = id // self.grid_size[0]
-                    mask_batch[sampleId,pos[1],pos[0],:] = torch.ones(self.enc_size).byte()
-                    count+=1
 
-        return hist_batch, weather_batch, nbrs_batch, mask_batch, lat_enc_batch, lon_enc_batch, fut_batch, op_mask_batch
+
+    ## Batched fetch: the same arrays as ngsimDataset.__getitems__
+    def __getitems__(self, indices):
+        idx = np.asarray(indices, dtype=np.int64)
+        a = self.arrays
+
+        # Neighbor rows of the samples (CSR), in (sample, grid cell) order
+        start = a["nbr_offsets"][idx]
+        count = a["nbr_offsets"][idx + 1] - start
+        nbr_sample = np.repeat(np.arange(len(idx)), count)
+        rows = np.repeat(start - (np.cumsum(count) - count), count) + np.arange(count.sum())
+
+        return {"hist": a["hist"][idx], "weather": a["weather"][idx], "fut": a["fut"][idx],
+                "fut_len": a["fut_len"][idx].astype(np.int64), "nbrs": a["nbrs"][rows], "nbr_sample": nbr_sample,
+                "nbr_cell": a["nbr_cell"][rows].astype(np.int64), "lat_enc": np.eye(3)[a["lat"][idx]],
+                "lon_enc": np.eye(2)[a["lon"][idx]]}
+
+
+
+    ## Sample in the format of ngsimDataset.__getitem__
+    def __getitem__(self, idx):
+        batch = self.__getitems__([idx])
+        neighbors = [np.empty([0,2]) for _ in range(self.grid_size[0] * self.grid_size[1])]
+        for nbr, cell in zip(batch["nbrs"], batch["nbr_cell"]):
+            neighbors[cell] = nbr
+        fut = batch["fut"][0, :batch["fut_len"][0]]
+        return batch["hist"][0], batch["weather"][0], fut, neighbors, batch["lat_enc"][0], batch["lon_enc"][0]
+
+
+
+    ## Reopen the memory maps instead of pickling the arrays (DataLoader workers started with spawn)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["arrays"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.header, self.arrays = open_arrays(self.path)
+
+
+
+    ## Collate functions of ngsimDataset
+    collate_fn = ngsimDataset.collate_fn
+    collate_batch = ngsimDataset.collate_batch
+
+
+
+### Sampler visiting the samples of an ngsimDataset in shuffled blocks of neighboring samples
+class blockShuffleSampler(Sampler):
+    """
+    Shuffles at the block level: the samples, ordered by (dataset ID, vehicle ID, frame), are cut into
+    blocks of block_size consecutive samples of the same recording (i.e. a range of vehicles of one
+    recording); every epoch the blocks are permuted and, with shuffle_blocks, the samples of each block
+    are shuffled. The samples of a batch then read nearby track rows instead of rows all over the split.
+    block_size=1 is a uniform shuffle; larger blocks trade randomness for locality.
+
+    Args:
+    - dataset: ngsimDataset.
+    - block_size: Samples per block.
+    - shuffle_blocks: Whether to shuffle the samples within each block.
+    - seed: Seed of the permutations (None: random).
+    """
+
+    def __init__(self, dataset, block_size=1024, shuffle_blocks=True, seed=None):
+        self.block_size = block_size
+        self.shuffle_blocks = shuffle_blocks
+        self.rng = np.random.default_rng(seed)
+
+        # Samples in (dataset ID, vehicle ID, frame) order and their block
+        samples = dataset.D[dataset.index]
+        self.order = np.lexsort((samples[:, 2], samples[:, 1], samples[:, 0]))
+        dsIds = samples[self.order, 0]
+        first = np.flatnonzero(np.r_[True, dsIds[1:] != dsIds[:-1]])
+        position = np.arange(len(dsIds)) - np.repeat(first, np.diff(np.r_[first, len(dsIds)]))
+        new_block = position % block_size == 0
+        self.block = np.cumsum(new_block) - 1
+        self.num_blocks = int(new_block.sum())
+
+
+
+    def __len__(self):
+        return len(self.order)
+
+
+
+    def __iter__(self):
+        rank = self.rng.permutation(self.num_blocks)[self.block]
+        if self.shuffle_blocks:
+            order = self.order[np.lexsort((self.rng.random(len(self.order)), rank))]
+        else:
+            order = self.order[np.argsort(rank, kind="stable")]
+        return iter(order.tolist())
+
+
+
+### Sampler visiting every stride-th frame of every vehicle, at an offset rotating every epoch
+class strideSampler(Sampler):
+    """
+    Consecutive frames of a vehicle (10 Hz) give nearly identical samples. Epoch e visits only the
+    samples whose frame ID is e (mod stride), so an epoch is about stride times shorter and all the
+    samples are visited once every stride epochs. len() is the number of samples of the current epoch
+    (the next one before the first epoch).
+
+    Args:
+    - dataset: ngsimDataset.
+    - stride: Frames between the samples of a vehicle in an epoch.
+    - shuffle: Whether to visit the samples of an epoch in random order.
+    - seed: Seed of the permutations (None: random).
+    """
+
+    def __init__(self, dataset, stride=5, shuffle=True, seed=None):
+        self.stride = stride
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.epoch = 0
+        self.offset = 0
+
+        # Offset (frame ID mod stride) of every sample
+        self.phase = dataset.D[dataset.index, 2].astype(np.int64) % stride
+        self.counts = np.bincount(self.phase, minlength=stride)
+
+
+
+    def __len__(self):
+        return int(self.counts[self.offset])
+
+
+
+    def __iter__(self):
+        self.offset = self.epoch % self.stride
+        self.epoch += 1
+        order = np.flatnonzero(self.phase == self.offset)
+        if self.shuffle:
+            order = self.rng.permutation(order)
+        return iter(order.tolist())
+
+
+
+### Batch assembler: the batches of an ngsimDataset built in this process, on the device of the model
+class batchAssembler:
+    """
+    Iterates over the batches of an ngsimDataset like a DataLoader with collate_fn=dataset.collate_fn (same
+    tensors), without worker processes. The positions and weather of all track rows and the rows of the
+    windows of all samples are moved to the device once; a batch is then gathered from them by index.
+
+    Args:
+    - dataset: ngsimDataset.
+    - batch_size: Samples per batch (the last batch may be smaller).
+    - shuffle: Whether to visit the samples in a new random order every epoch.
+    - device: Device of the tensors (the device of the model).
+    - chunk_size: Samples whose window rows are looked up at a time when the assembler is set up.
+    - sampler: Sampler of the order of the samples (e.g. blockShuffleSampler), instead of shuffle.
+    """
+
+    def __init__(self, dataset, batch_size=128, shuffle=False, device="cpu", chunk_size=65536, sampler=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.sampler = sampler
+        self.device = torch.device(device)
+        ds = dataset
+        n_cells = ds.grid_size[0] * ds.grid_size[1]
+
+        # Positions and weather of every track row
+        self.pos = torch.from_numpy(np.ascontiguousarray(ds.T.values[:, 1:3])).to(self.device)
+        if ds.weather_table is not None:
+            weather = ds.weather_table[ds.W.values]
+        else:
+            weather = ds.W.values[:, ds.weather_cols]
+        self.weather = torch.from_numpy(np.ascontiguousarray(weather)).to(self.device)
+
+        # Window rows of every sample: frame row and end of the future of the ego, first history row of the
+        # ego and of the vehicle in every grid cell (-1: no full history)
+        ref_row = np.empty(len(ds), dtype=np.int64)
+        fut_end = np.empty(len(ds), dtype=np.int64)
+        hist_start = np.empty(len(ds), dtype=np.int64)
+        nbr_start = np.empty((len(ds), n_cells), dtype=np.int32)
+        lat = np.empty(len(ds), dtype=np.int64)
+        lon = np.empty(len(ds), dtype=np.int64)
+        for start in range(0, len(ds), chunk_size):
+            chunk = slice(start, min(start + chunk_size, len(ds)))
+            samples = ds.D[ds.index[chunk]]
+            dsIds = samples[:, 0].astype(np.int64)
+            t = samples[:, 2]
+            grid = samples[:, ds.label_col+2:].astype(np.int64)
+
+            k = ds.T.slots_of(dsIds, samples[:, 1])
+            row = ds.T.frame_rows(k, t)
+            rows, full = history_rows(ds.T, k, row, ds.t_h, ds.d_s)
+            ref_row[chunk] = row
+            fut_end[chunk] = np.minimum(ds.T.offsets[k + 1], row + ds.t_f + 1)
+            hist_start[chunk] = np.where(full, rows[:, 0], -1)
+
+            nbr_k = ds.T.slots_of(np.repeat(dsIds, n_cells), grid.ravel())
+            nbr_row = ds.T.frame_rows(nbr_k, np.repeat(t, n_cells))
+            rows, full = history_rows(ds.T, nbr_k, nbr_row, ds.t_h, ds.d_s)
+            nbr_start[chunk] = np.where(full, rows[:, 0], -1).reshape(-1, n_cells)
+
+            lat[chunk] = samples[:, ds.label_col] - 1
+            lon[chunk] = samples[:, ds.label_col+1] - 1
+
+        self.ref_row = torch.from_numpy(ref_row).to(self.device)
+        self.fut_end = torch.from_numpy(fut_end).to(self.device)
+        self.hist_start = torch.from_numpy(hist_start).to(self.device)
+        self.nbr_start = torch.from_numpy(nbr_start).to(self.device)
+        self.lat = torch.from_numpy(lat).to(self.device)
+        self.lon = torch.from_numpy(lon).to(self.device)
+
+        # History and future steps, in rows
+        self.hist_steps = ds.d_s * torch.arange(ds.t_h//ds.d_s + 1, device=self.device)
+        self.fut_steps = ds.d_s * torch.arange(1, ds.t_f//ds.d_s + 1, device=self.device)
+
+
+
+    def __len__(self):
+        samples = len(self.dataset) if self.sampler is None else len(self.sampler)
+        return (samples + self.batch_size - 1) // self.batch_size
+
+
+
+    def __iter__(self):
+        if self.sampler is not None:
+            order = torch.tensor(list(self.sampler), dtype=torch.int64, device=self.device)
+        elif self.shuffle:
+            order = torch.randperm(len(self.dataset)).to(self.device)
+        else:
+            order = torch.arange(len(self.dataset), device=self.device)
+        for start in range(0, len(order), self.batch_size):
+            yield self.batch(order[start:start + self.batch_size])
+
+
+
+    ## Batch tensors (same as dataset.collate_fn) of the samples idx (tensor of dataset indices)
+    def batch(self, idx):
+        idx = torch.as_tensor(idx, dtype=torch.int64, device=self.device)
+        grid_size = self.dataset.grid_size
+
+        # Ego history (zero without a full history) and future, relative to the ego position at frame t
+        ref_row = self.ref_row[idx]
+        refPos = self.pos[ref_row]
+        hist_start = self.hist_start[idx]
+        full = (hist_start >= 0)[:, None, None]
+        rows = hist_start.clamp(min=0)[:, None] + self.hist_steps
+        hist = torch.where(full, self.pos[rows] - refPos[:, None], 0)
+        weather = torch.where(full, self.weather[rows], 0)
+        rows = ref_row[:, None] + self.fut_steps
+        op_mask = rows < self.fut_end[idx, None]
+        fut = torch.where(op_mask[..., None], self.pos[torch.where(op_mask, rows, 0)] - refPos[:, None], 0)
+
+        # Neighbor histories, in (sample, grid cell) order, and the occupancy of the grid cells
+        nbr_start = self.nbr_start[idx]
+        occupied = nbr_start >= 0
+        nbr_sample, nbr_cell = occupied.nonzero(as_tuple=True)
+        rows = nbr_start[nbr_sample, nbr_cell].long()[:, None] + self.hist_steps
+        nbrs = self.pos[rows] - refPos[nbr_sample, None]
+        mask = occupied.view(len(idx), grid_size[1], grid_size[0])
+
+        # Maneuvers (one-hot)
+        lat_enc = torch.nn.functional.one_hot(self.lat[idx], 3).float()
+        lon_enc = torch.nn.functional.one_hot(self.lon[idx], 2).float()
+
+        # (steps, samples, ...) float32 sequences, as in collate_batch
+        hist, weather, nbrs, fut = (x.transpose(0, 1).float().contiguous() for x in (hist, weather, nbrs, fut))
+        op_mask = op_mask.t()[..., None].repeat(1, 1, 2).float()
+        return hist, weather, nbrs, mask, lat_enc, lon_enc, fut, op_mask
+
+
+
+### Batch loader: worker processes that write collated batches into shared memory slots
+class sharedBatchLoader:
+    """
+    Iterates over the batches of a dataset (ngsimDataset or materializedDataset) like a DataLoader with
+    collate_fn=dataset.collate_fn, but the workers write each collated batch into one of num_slots
+    preallocated shared memory batch slots and send back only its slot and tensor shapes, instead of
+    pickling the tensors through a queue. The batch tensors are views of the slot: they are valid until
+    the next batch is requested (the slot is then reused), so copy what must outlive the step.
+
+    Args:
+    - dataset: Dataset with __getitems__ and collate_fn.
+    - batch_size: Samples per batch (the last batch may be smaller).
+    - shuffle: Whether to visit the samples in a new random order every epoch.
+    - num_workers: Worker processes (started on the first epoch and kept until close()).
+    - num_slots: Batch slots, at least num_workers + 1 (default: 2 * num_workers), i.e. batches in flight.
+    - multiprocessing_context: Start method of the workers ("fork", "spawn", ...; default of the platform).
+    - sampler: Sampler of the order of the samples (e.g. blockShuffleSampler), instead of shuffle.
+    """
+
+    def __init__(self, dataset, batch_size=128, shuffle=False, num_workers=4, num_slots=None,
+                 multiprocessing_context=None, sampler=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.sampler = sampler
+        self.num_workers = num_workers
+        self.num_slots = max(num_slots or 2 * num_workers, num_workers + 1)
+        self.context = torch.multiprocessing.get_context(multiprocessing_context)
+
+        # Slots: one flat shared tensor per batch tensor, large enough for a full batch with all grid cells occupied
+        n_hist = dataset.t_h//dataset.d_s + 1
+        n_fut = dataset.t_f//dataset.d_s
+        n_cells = dataset.grid_size[0] * dataset.grid_size[1]
+        sizes = [n_hist * batch_size * 2, n_hist * batch_size * dataset.weather_size, n_hist * batch_size * n_cells * 2,
+                 batch_size * n_cells, batch_size * 3, batch_size * 2, n_fut * batch_size * 2, n_fut * batch_size * 2]
+        dtypes = [torch.float32] * 3 + [torch.bool] + [torch.float32] * 4
+        self.slots = [[torch.zeros(size, dtype=dtype).share_memory_() for size, dtype in zip(sizes, dtypes)]
+                      for _ in range(self.num_slots)]
+
+        self.workers = []
+        self.in_flight = 0
+
+
+
+    def __len__(self):
+        samples = len(self.dataset) if self.sampler is None else len(self.sampler)
+        return (samples + self.batch_size - 1) // self.batch_size
+
+
+
+    def __iter__(self):
+        if not self.workers:
+            self.start()
+        # Batches of an epoch left unfinished
+        while self.in_flight:
+            self.result()
+
+        if self.sampler is not None:
+            order = np.array(list(self.sampler), dtype=np.int64)
+        elif self.shuffle:
+            order = np.random.permutation(len(self.dataset))
+        else:
+            order = np.arange(len(self.dataset))
+        batches = [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+
+        # Batches are sent to the workers with a free slot each and handed out in order; the slot of a batch
+        # is free again once the next batch is requested
+        free = list(range(self.num_slots))
+        ready = {}
+        sent = 0
+        for batch_no in range(len(batches)):
+            while free and sent < len(batches):
+                self.tasks.put((sent, free.pop(), batches[sent]))
+                self.in_flight += 1
+                sent += 1
+            while batch_no not in ready:
+                done_no, slot, shapes = self.result()
+                ready[done_no] = slot, shapes
+            slot, shapes = ready.pop(batch_no)
+            yield tuple(x[:int(np.prod(shape))].view(shape) for x, shape in zip(self.slots[slot], shapes))
+            free.append(slot)
+
+
+
+    ## Start the worker processes
+    def start(self):
+        self.tasks = self.context.Queue()
+        self.done = self.context.Queue()
+        for _ in range(self.num_workers):
+            worker = self.context.Process(target=_shared_batch_worker,
+                                          args=(self.dataset, self.slots, self.tasks, self.done), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+
+
+    ## Batch number, slot and tensor shapes of the next batch written by a worker
+    def result(self):
+        while True:
+            try:
+                batch_no, slot, shapes = self.done.get(timeout=5)
+                break
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("sharedBatchLoader: a worker process exited unexpectedly")
+        self.in_flight -= 1
+        if isinstance(shapes, str):
+            raise RuntimeError("sharedBatchLoader: batch %d failed in a worker:\n%s" % (batch_no, shapes))
+        return batch_no, slot, shapes
+
+
+
+    ## Stop the worker processes
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.in_flight = 0
+
+
+## Worker of sharedBatchLoader: collates the batches of (batch number, slot, indices) tasks into their slots
+def _shared_batch_worker(dataset, slots, tasks, done):
+    torch.set_num_threads(1)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        batch_no, slot, indices = task
+        try:
+            batch = dataset.collate_fn(dataset.__getitems__(indices))
+            for x, tensor in zip(slots[slot], batch):
+                x[:tensor.numel()].view(tensor.shape).copy_(tensor)
+            done.put((batch_no, slot, [tuple(tensor.shape) for tensor in batch]))
+        except Exception:
+            done.put((batch_no, slot, traceback.format_exc()))
 
 #________________________________________________________________________________________________________________________________________
 
@@ -170,6 +774,19 @@ class ngsimDataset(Dataset):
 
 
 
+## Zero padded (sequences, maxlen, width) float32 array of (length, width) sequences, and their lengths
+def pack_sequences(sequences, maxlen, width):
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    packed = np.zeros((len(sequences), maxlen, width), dtype=np.float32)
+    if lengths.any():
+        # Sequence and step of every row of the concatenated sequences
+        seq = np.repeat(np.arange(len(sequences)), lengths)
+        step = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        packed[seq, step] = np.concatenate([x for x in sequences if len(x)])
+    return packed, lengths
+
+
+
 ## Custom activation for output layer (Graves, 2015)
 def outputActivation(x):
     muX = x[:,:,0:1]
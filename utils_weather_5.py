@@ -1,183 +1,14 @@
 from __future__ import print_function, division
-from torch.utils.data import Dataset, DataLoader
-import scipy.io as scp
-import numpy as np
 import torch
+import utils_weather
 
 # ___________________________________________________________________________________________________________________________
 
 
-### Dataset class for the NGSIM dataset
-class ngsimDataset(Dataset):
-
-    def __init__(self, mat_file, t_h=30, t_f=50, d_s=2, enc_size=64, grid_size=(13, 3)):
-        # self.D = scp.loadmat(mat_file)['traj']
-        # self.T = scp.loadmat(mat_file)['tracks']
-
-        if mat_file[-3:] == "mat":
-            self.D = scp.loadmat(mat_file)["traj"]
-            self.T = scp.loadmat(mat_file)["tracks"]
-        else:
-            self.D = np.load(mat_file, allow_pickle=True)
-            self.T = np.load(mat_file, allow_pickle=True)
-            self.D = self.D.item()["traj"]
-            self.T = self.T.item()["tracks"]
-
-        self.t_h = t_h  # length of track history
-        self.t_f = t_f  # length of predicted trajectory
-        self.d_s = d_s  # down sampling rate of all sequences
-        self.enc_size = enc_size  # size of encoder LSTM
-        self.grid_size = grid_size  # size of social context grid
-
-    def __len__(self):
-        return len(self.D)
-
-    def __getitem__(self, idx):
-
-        dsId = self.D[idx, 0].astype(int)
-        vehId = self.D[idx, 1].astype(int)
-        t = self.D[idx, 2]
-        grid = self.D[idx, 8 + 5 :]
-        neighbors = []
-
-        # Get track history 'hist' = ndarray, and future track 'fut' = ndarray
-        hist, weather = self.getHistory(vehId, t, vehId, dsId)
-        fut = self.getFuture(vehId, t, dsId)
-
-        # Get track histories of all neighbours 'neighbors' = [ndarray,[],ndarray,ndarray]
-        for i in grid:
-            nbr_hist, _ = self.getHistory(i.astype(int), t, vehId, dsId)
-            neighbors.append(nbr_hist)
-
-        # Maneuvers 'lon_enc' = one-hot vector, 'lat_enc = one-hot vector
-        lon_enc = np.zeros([2])
-        lon_enc[int(self.D[idx, 7 + 5] - 1)] = 1
-        lat_enc = np.zeros([3])
-        lat_enc[int(self.D[idx, 6 + 5] - 1)] = 1
-
-        return hist, weather, fut, neighbors, lat_enc, lon_enc
-
-    ## Helper function to get track history
-    def getHistory(self, vehId, t, refVehId, dsId):
-        if vehId == 0:
-            return np.empty([0, 2]), np.empty([0, 5])
-        else:
-            if self.T.shape[1] <= vehId - 1:
-                return np.empty([0, 2]), np.empty([0, 5])
-            # refTrack = self.T[dsId-1][refVehId-1].transpose()
-            # vehTrack = self.T[dsId-1][vehId-1].transpose()
-            ## Updated ##
-            refTrack = self.T[dsId - 1][refVehId - 1]
-            vehTrack = self.T[dsId - 1][vehId - 1]
-
-            if refTrack is None or vehTrack is None:
-                return np.empty([0, 2]), np.empty([0, 5])
-
-            refTrack = refTrack.transpose()
-            vehTrack = vehTrack.transpose()
-            ##
-            refPos = refTrack[np.where(refTrack[:, 0] == t)][0, 1:3]
-
-            if vehTrack.size == 0 or np.argwhere(vehTrack[:, 0] == t).size == 0:
-                return np.empty([0, 2]), np.empty([0, 5])
-            else:
-                stpt = np.maximum(0, np.argwhere(vehTrack[:, 0] == t).item() - self.t_h)
-                enpt = np.argwhere(vehTrack[:, 0] == t).item() + 1
-                hist = vehTrack[stpt : enpt : self.d_s, 1:3] - refPos  # get future
-                weather = vehTrack[stpt : enpt : self.d_s, -3:]
-            if len(hist) < self.t_h // self.d_s + 1:
-                return np.empty([0, 2]), np.empty([0, 5])
-            return hist, weather
-
-    ## Helper function to get track future
-    def getFuture(self, vehId, t, dsId):
-        vehTrack = self.T[dsId - 1][vehId - 1].transpose()
-        refPos = vehTrack[np.where(vehTrack[:, 0] == t)][0, 1:3]
-        stpt = np.argwhere(vehTrack[:, 0] == t).item() + self.d_s
-        enpt = np.minimum(
-            len(vehTrack), np.argwhere(vehTrack[:, 0] == t).item() + self.t_f + 1
-        )
-        fut = vehTrack[stpt : enpt : self.d_s, 1:3] - refPos
-        return fut
-
-    ## Collate function for dataloader
-    def collate_fn(self, samples):
-
-        # Initialize neighbors and neighbors length batches:
-        nbr_batch_size = 0
-        for _, _, _, nbrs, _, _ in samples:
-            nbr_batch_size += sum([len(nbrs[i]) != 0 for i in range(len(nbrs))])
-        maxlen = self.t_h // self.d_s + 1
-        nbrs_batch = torch.zeros(maxlen, nbr_batch_size, 2)
-
-        # Initialize social mask batch:
-        pos = [0, 0]
-        mask_batch = torch.zeros(
-            len(samples), self.grid_size[1], self.grid_size[0], self.enc_size
-        )
-        mask_batch = mask_batch.byte()
-
-        # Initialize history, history lengths, future, output mask, lateral maneuver and longitudinal maneuver batches:
-        hist_batch = torch.zeros(maxlen, len(samples), 2)
-        weather_batch = torch.zeros(maxlen, len(samples), 5)
-        fut_batch = torch.zeros(self.t_f // self.d_s, len(samples), 2)
-        op_mask_batch = torch.zeros(self.t_f // self.d_s, len(samples), 2)
-        lat_enc_batch = torch.zeros(len(samples), 3)
-        lon_enc_batch = torch.zeros(len(samples), 2)
-
-        count = 0
-        for sampleId, (hist, weather, fut, nbrs, lat_enc, lon_enc) in enumerate(
-            samples
-        ):
-
-            # Set up history, future, lateral maneuver and longitudinal maneuver batches:
-            hist_batch[0 : len(hist), sampleId, 0] = torch.from_numpy(hist[:, 0])
-            hist_batch[0 : len(hist), sampleId, 1] = torch.from_numpy(hist[:, 1])
-            weather_batch[0 : len(weather), sampleId, 0] = torch.from_numpy(
-                weather[:, 0]
-            )
-            weather_batch[0 : len(weather), sampleId, 1] = torch.from_numpy(
-                weather[:, 1]
-            )
-            weather_batch[0 : len(weather), sampleId, 2] = torch.from_numpy(
-                weather[:, 2]
-            )
-            weather_batch[0 : len(weather), sampleId, 3] = torch.from_numpy(
-                weather[:, 3]
-            )
-            weather_batch[0 : len(weather), sampleId, 4] = torch.from_numpy(
-                weather[:, 4]
-            )
-            fut_batch[0 : len(fut), sampleId, 0] = torch.from_numpy(fut[:, 0])
-            fut_batch[0 : len(fut), sampleId, 1] = torch.from_numpy(fut[:, 1])
-            op_mask_batch[0 : len(fut), sampleId, :] = 1
-            lat_enc_batch[sampleId, :] = torch.from_numpy(lat_enc)
-            lon_enc_batch[sampleId, :] = torch.from_numpy(lon_enc)
-
-            # Set up neighbor, neighbor sequence length, and mask batches:
-            for id, nbr in enumerate(nbrs):
-                if len(nbr) != 0:
-                    # print(nbr)
-                    # print(np.shape(nbr))
-                    nbrs_batch[0 : len(nbr), count, 0] = torch.from_numpy(nbr[:, 0])
-                    nbrs_batch[0 : len(nbr), count, 1] = torch.from_numpy(nbr[:, 1])
-                    pos[0] = id % self.grid_size[0]
-                    pos[1] = id // self.grid_size[0]
-                    mask_batch[sampleId, pos[1], pos[0], :] = torch.ones(
-                        self.enc_size
-                    ).byte()
-                    count += 1
-
-        return (
-            hist_batch,
-            weather_batch,
-            nbrs_batch,
-            mask_batch,
-            lat_enc_batch,
-            lon_enc_batch,
-            fut_batch,
-            op_mask_batch,
-        )
+### Dataset class for the NGSIM dataset, with the 5 weather features
+class ngsimDataset(utils_weather.ngsimDataset):
+    def __init__(self, mat_file, t_h=30, t_f=50, d_s=2, enc_size=64, grid_size=(13, 3), weather_features=5):
+        super().__init__(mat_file, t_h, t_f, d_s, enc_size, grid_size, weather_features)
 
 
 # ________________________________________________________________________________________________________________________________________